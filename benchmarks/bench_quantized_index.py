@@ -0,0 +1,192 @@
+"""
+Бенчмарк хранения векторов: ChromaDB (collection.query) против квантованного индекса
+(VECTOR_INDEX_MODE=float16 / int8, VectorFile + точное переранжирование).
+
+Для каждого размера синтетической базы знаний (векторы размерности ada-002) и каждого режима:
+  1. отдельный процесс строит коллекцию через VectorStore.add_qa_pairs();
+  2. новый процесс открывает ее через VectorStore, выполняет запросы через search_similar()
+     и сообщает RSS процесса (анонимная память и страницы файлов) и задержки.
+Затем сравниваются recall@1 с точным поиском, совпадение решения по порогу 0.3 и,
+для квантованных режимов, recall@1 без переранжирования.
+
+RSS anon - частная память процесса (у gunicorn умножается на число воркеров), RSS file - страницы
+файлов в page cache (общие для процессов и вытесняемые ядром; сюда же попадают страницы VectorFile
+и библиотек, загруженных при поиске). Обе величины - прирост относительно процесса после импорта chromadb.
+
+Половина записей базы - близкие перефразировки других записей, а запросы лежат между записью
+и ее перефразировкой: на таких запросах ошибка квантования int8 может поменять лучший результат.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_quantized_index --sizes 10000 50000
+"""
+import argparse
+import json
+import logging # Импортируем модуль логирования
+import os # Для работы с путями
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DIMENSION = 1536
+DISTANCE_THRESHOLD = 0.3
+MODES = ("chroma", "float16", "int8")
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def make_dataset(path, n_items, n_queries, paraphrase_noise, seed):
+    rng = np.random.default_rng(seed)
+    # Реальные эмбеддинги ada-002 не ортогональны: у них есть общая компонента
+    common = rng.standard_normal(DIMENSION)
+    kb = normalize(common + 1.2 * rng.standard_normal((n_items, DIMENSION))).astype(np.float32)
+    paraphrases = np.nonzero(rng.random(n_items) < 0.5)[0]
+    sources = rng.integers(0, n_items, len(paraphrases))
+    kb[paraphrases] = normalize(kb[sources] + paraphrase_noise * rng.standard_normal((len(paraphrases), DIMENSION)))
+
+    # Запрос - смесь записи и ее перефразировки плюс шум разного уровня
+    picks = rng.integers(0, len(paraphrases), n_queries)
+    weights = rng.uniform(0.3, 0.7, (n_queries, 1))
+    noise = rng.uniform(0.0, 0.02, (n_queries, 1)) * rng.standard_normal((n_queries, DIMENSION))
+    queries = normalize(weights * kb[paraphrases[picks]] + (1 - weights) * kb[sources[picks]] + noise).astype(np.float32)
+
+    truth_rows = np.empty(n_queries, dtype=np.int64)
+    truth_distances = np.empty(n_queries, dtype=np.float64)
+    kb64 = kb.astype(np.float64)
+    for i, query in enumerate(queries.astype(np.float64)):
+        distances = np.einsum('ij,ij->i', kb64 - query, kb64 - query)
+        truth_rows[i] = int(np.argmin(distances))
+        truth_distances[i] = distances[truth_rows[i]]
+    np.save(os.path.join(path, "kb.npy"), kb)
+    np.save(os.path.join(path, "queries.npy"), queries)
+    return truth_rows, truth_distances
+
+
+def rss():
+    """RSS текущего процесса в байтах: (анонимная память, страницы файлов)."""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                values[key] = int(value.split()[0]) * 1024
+    return values["RssAnon"], values["RssFile"]
+
+
+def open_store(data_path, db_path, mode):
+    from database.embeddings import EmbeddingProvider
+    from database.vector_store import VectorStore
+
+    class SyntheticEmbeddingProvider(EmbeddingProvider):
+        """Выдает заранее сгенерированные векторы по тексту вида 'kb:<номер>' или 'q:<номер>'."""
+        name = "synthetic:bench"
+        dimension = DIMENSION
+        batch_size = 500
+
+        def __init__(self):
+            super().__init__()
+            self.vectors = {"kb": np.load(os.path.join(data_path, "kb.npy"), mmap_mode='r'),
+                            "q": np.load(os.path.join(data_path, "queries.npy"), mmap_mode='r')}
+            self.is_ready = True
+
+        def _embed_batch(self, texts):
+            return [self.vectors[kind][int(row)].tolist() for kind, row in (text.split(":") for text in texts)]
+
+    return VectorStore(db_path=db_path, collection_name="bench", index_mode="" if mode == "chroma" else mode,
+                       embedding_provider=SyntheticEmbeddingProvider())
+
+
+def build(data_path, db_path, mode):
+    store = open_store(data_path, db_path, mode)
+    n_items = len(np.load(os.path.join(data_path, "kb.npy"), mmap_mode='r'))
+    store.add_qa_pairs([(f"kb:{row}", f"answer {row}", {"row": row}) for row in range(n_items)])
+
+
+def serve(data_path, db_path, mode):
+    n_queries = len(np.load(os.path.join(data_path, "queries.npy"), mmap_mode='r'))
+    # Импорт chromadb сам по себе занимает десятки МБ - базовую точку берем после него
+    import database.vector_store  # noqa: F401
+    baseline = rss()
+    store = open_store(data_path, db_path, mode)
+    store.search_similar("q:0")  # ChromaDB загружает HNSW-сегмент при первом запросе
+    loaded = rss()
+
+    rows, distances, latencies, approximate_rows = [], [], [], []
+    for i in range(n_queries):
+        start = time.perf_counter()
+        results = store.search_similar(f"q:{i}", n_results=1)
+        latencies.append(time.perf_counter() - start)
+        rows.append(results['metadatas'][0]['row'] if results['metadatas'] else -1)
+        distances.append(results['distances'][0] if results['distances'] else float('inf'))
+        if store.index is not None:
+            query = store.embedding_provider.vectors["q"][i]
+            approximate_rows.append(store.index.candidates(query, 1)[0][0])
+    finished = rss()
+
+    print(json.dumps({
+        "rss_anon_loaded": loaded[0] - baseline[0], "rss_file_loaded": loaded[1] - baseline[1],
+        "rss_anon_after": finished[0] - baseline[0], "rss_file_after": finished[1] - baseline[1],
+        "index_bytes": store.index.nbytes() if store.index is not None else None,
+        "latencies": latencies, "rows": rows, "distances": distances, "approximate_rows": approximate_rows
+    }))
+
+
+def run_step(step, data_path, db_path, mode):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_quantized_index", f"--{step}", data_path, db_path, mode],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return output.strip().splitlines()[-1] if output.strip() else None
+
+
+def bench(n_items, n_queries, paraphrase_noise, seed, modes=MODES):
+    with tempfile.TemporaryDirectory() as tmp:
+        truth_rows, truth_distances = make_dataset(tmp, n_items, n_queries, paraphrase_noise, seed)
+        print(f"\n=== KB: {n_items} записей x {DIMENSION}, запросов: {n_queries}, "
+              f"дистанция <= {DISTANCE_THRESHOLD} у {np.mean(truth_distances <= DISTANCE_THRESHOLD):.0%} запросов ===")
+        print(f"{'режим':8} {'RSS anon':>10} {'RSS file':>10} {'индекс':>9} {'p50 мс':>8} {'p95 мс':>8} "
+              f"{'recall@1':>9} {'без перерн.':>11} {'порог':>7}")
+        for mode in modes:
+            db_path = os.path.join(tmp, f"db_{mode}")
+            run_step("build", tmp, db_path, mode)
+            report = json.loads(run_step("serve", tmp, db_path, mode))
+
+            latencies = np.array(report["latencies"]) * 1000
+            rows = np.array(report["rows"])
+            recall = np.mean(rows == truth_rows)
+            threshold_agree = np.mean((np.array(report["distances"]) <= DISTANCE_THRESHOLD) == (truth_distances <= DISTANCE_THRESHOLD))
+            approximate = (f"{np.mean(np.array(report['approximate_rows']) == truth_rows):.4f}"
+                           if report["approximate_rows"] else "-")
+            index_size = f"{report['index_bytes'] / 2**20:.1f}" if report["index_bytes"] is not None else "-"
+            print(f"{mode:8} {report['rss_anon_after'] / 2**20:8.1f}MB {report['rss_file_after'] / 2**20:8.1f}MB "
+                  f"{index_size:>7}MB {np.percentile(latencies, 50):8.2f} {np.percentile(latencies, 95):8.2f} "
+                  f"{recall:9.4f} {approximate:>11} {threshold_agree:7.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--paraphrase-noise', type=float, default=0.002)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--build', nargs=3, metavar=('DATA', 'DB', 'MODE'), help=argparse.SUPPRESS)
+    parser.add_argument('--serve', nargs=3, metavar=('DATA', 'DB', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build or args.serve:
+        # Дочерние процессы печатают только результат
+        logging.basicConfig(level=logging.ERROR)
+        build(*args.build) if args.build else serve(*args.serve)
+        return
+
+    for n_items in args.sizes:
+        bench(n_items, args.queries, args.paraphrase_noise, args.seed, args.modes)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,15 @@ import sqlite3
 import os # <--- ДОБАВЛЕН ОБРАТНО
 import logging # <--- ДОБАВЛЕН ОБРАТНО
 import datetime
+import threading
 import requests
 
 # Импортируем классы и переменные из твоих модулей
-from config import TELEGRAM_TOKEN, MANAGER_CHAT_ID, GOOGLE_CREDENTIALS, GOOGLE_SHEETS_ID, OPENAI_API_KEY
+from config import (TELEGRAM_TOKEN, MANAGER_CHAT_ID, GOOGLE_CREDENTIALS, GOOGLE_SHEETS_ID, OPENAI_API_KEY,
+                    JOB_CALLBACK_URL, JOB_WORKERS, JOB_RETENTION_DAYS, KB_REGISTRY_PATH, KB_MAX_LOADED, OPENAI_REQUEST_TIMEOUT)
 from utils.google_sheets import GoogleSheetsManager
-from database.vector_store import VectorStore
+from utils.job_queue import JobQueue, JobWorkerPool
+from utils.knowledge_bases import DEFAULT_KB_ID, KnowledgeBaseRegistry, load_kb_settings
 
 from flask import Flask, request, jsonify
 import openai
@@ -36,9 +39,7 @@ def load_system_instructions(file_path="system_prompt.txt"):
         logger.error(f"Ошибка чтения файла инструкций {absolute_file_path}: {e}")
         return "You are a helpful assistant."
 
-# --- Загружаем инструкции при запуске приложения ---
-SYSTEM_INSTRUCTIONS_TEXT = load_system_instructions()
-logger.info("Системные инструкции загружены.")
+# Системные инструкции у каждой базы знаний свои и загружаются вместе с базой (см. KnowledgeBaseRegistry)
 
 # В файле bot.py, можно разместить после импортов и настройки логгера,
 # или перед классом QABot.
@@ -56,9 +57,15 @@ def init_history_db():
                 user_id TEXT NOT NULL,
                 role TEXT NOT NULL, -- 'user' or 'assistant'
                 content TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                kb_id TEXT NOT NULL DEFAULT 'default'
             )
         """)
+        # Миграция баз, созданных до появления нескольких баз знаний: история делится по kb_id
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(chat_history)")]
+        if 'kb_id' not in columns:
+            cursor.execute("ALTER TABLE chat_history ADD COLUMN kb_id TEXT NOT NULL DEFAULT 'default'")
+            logger.info("В таблицу chat_history добавлена колонка kb_id.")
         conn.commit()
         logger.info(f"База данных истории '{DB_NAME}' успешно инициализирована.")
     except sqlite3.Error as e:
@@ -67,15 +74,15 @@ def init_history_db():
         if conn:
             conn.close()
 
-def add_message_to_history(user_id: str, role: str, content: str):
-    """Добавляет сообщение в историю чата для указанного user_id."""
+def add_message_to_history(user_id: str, role: str, content: str, kb_id: str = DEFAULT_KB_ID):
+    """Добавляет сообщение в историю чата для указанного user_id в базе знаний kb_id."""
     try:
         conn = sqlite3.connect(DB_NAME)
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO chat_history (user_id, role, content)
-            VALUES (?, ?, ?)
-        """, (user_id, role, content))
+            INSERT INTO chat_history (user_id, role, content, kb_id)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, role, content, kb_id))
         conn.commit()
         logger.debug(f"Сообщение от '{role}' для user_id '{user_id}' добавлено в историю.")
         return True
@@ -86,8 +93,8 @@ def add_message_to_history(user_id: str, role: str, content: str):
         if conn:
             conn.close()
 
-def get_recent_history(user_id: str, n_turns: int = 5) -> list:
-    """Извлекает последние N пар сообщений (вопрос-ответ) для указанного user_id."""
+def get_recent_history(user_id: str, n_turns: int = 5, kb_id: str = DEFAULT_KB_ID) -> list:
+    """Извлекает последние N пар сообщений (вопрос-ответ) для указанного user_id в базе знаний kb_id."""
     history = []
     # Мы хотим получить n_turns * 2 сообщений (вопрос + ответ = 1 ход)
     limit = n_turns * 2 
@@ -96,10 +103,10 @@ def get_recent_history(user_id: str, n_turns: int = 5) -> list:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT role, content FROM chat_history
-            WHERE user_id = ?
+            WHERE user_id = ? AND kb_id = ?
             ORDER BY timestamp DESC
             LIMIT ?
-        """, (user_id, limit))
+        """, (user_id, kb_id, limit))
         
         rows = cursor.fetchall()
         # Сообщения извлекаются в обратном хронологическом порядке (от новых к старым),
@@ -136,34 +143,17 @@ class QABot:
             logger.error("Ключ OPENAI_API_KEY не найден. OpenAI вызовы не будут работать.")
 
         self.sheets_manager = GoogleSheetsManager(GOOGLE_CREDENTIALS, GOOGLE_SHEETS_ID)
-        self.vector_store = VectorStore(db_path="./db") 
-        self.load_qa_data()
-        logger.info("Экземпляр QABot: sheets_manager и vector_store инициализированы, данные загружены.")
-
-    def load_qa_data(self):
-        logger.info("Начало загрузки данных из Google Sheets...")
-        qa_data_df = self.sheets_manager.get_qa_data()
-
-        if not qa_data_df.empty:
-            logger.info(f"Прочитано {len(qa_data_df)} строк из Google Sheets. Начинаем добавление в векторную базу.")
-            self.vector_store.reset() 
-            logger.info(f"Старая коллекция в векторной базе очищена перед загрузкой новых данных.")
-            
-            for index, row in qa_data_df.iterrows():
-                question = row.get('Вопрос')
-                answer = row.get('Ответ')
-                category = row.get('Категория', 'general') 
-
-                if question and answer: 
-                    metadata = {'category': category} 
-                    self.vector_store.add_qa_pair(question, answer, metadata=metadata)
-                else:
-                    logger.warning(f"Пропущена строка {index + 2} в Google Sheets из-за отсутствия вопроса или ответа: {row.to_dict()}")
-            logger.info(f"Загрузка данных завершена. В векторной базе {self.vector_store.count()} элементов.")
-        else:
-            logger.warning("Не удалось загрузить данные из Google Sheets или таблица пуста.")
-    
-    def send_to_manager(self, question: str, user_id: str, user_name: str = "Не указано"):
+        # Базы знаний загружаются лениво при первом обращении, а не при старте
+        self.kb_registry = KnowledgeBaseRegistry(
+            load_kb_settings(KB_REGISTRY_PATH),
+            self.sheets_manager,
+            load_system_instructions,
+            db_path="./db",
+            max_loaded=KB_MAX_LOADED
+        )
+        logger.info("Экземпляр QABot: sheets_manager и реестр баз знаний инициализированы.")
+
+    def send_to_manager(self, question: str, user_id: str, user_name: str = "Не указано", kb_id: str = DEFAULT_KB_ID):
         """ Отправляет вопрос менеджеру через Webhook Make.com. """
         logger.info(f"Попытка отправки вопроса менеджеру через Make.com от {user_name} (ID: {user_id}): {question}")
 
@@ -177,6 +167,7 @@ class QABot:
             "user_id": user_id,
             "user_name": user_name, 
             "question": question,
+            "kb_id": kb_id,
             "timestamp": datetime.datetime.utcnow().isoformat() + "Z" 
         }
         
@@ -204,6 +195,142 @@ except ValueError as ve:
 except Exception as e:
     logger.error(f"Непредвиденная КРИТИЧЕСКАЯ ОШИБКА при инициализации QABot: {e}.", exc_info=True)
 
+# --- Основная логика ассистента (общая для синхронного и асинхронного режимов) ---
+def process_message(user_id: str, user_name: str, user_message: str, kb_id: str = DEFAULT_KB_ID):
+    """
+    Обрабатывает сообщение пользователя в базе знаний kb_id: история, поиск контекста,
+    ответ OpenAI или передача менеджеру. Возвращает (тело ответа, HTTP-статус).
+    """
+    knowledge_base = qa_bot_instance.kb_registry.get(kb_id)
+    if knowledge_base is None:
+        logger.warning(f"Запрошена неизвестная база знаний '{kb_id}'.")
+        return {"error": f"Unknown kb_id '{kb_id}'"}, 404
+    if not knowledge_base.is_available():
+        logger.warning(f"База знаний '{kb_id}' еще собирается. Запрос не обработан.")
+        return {"error": f"Knowledge base '{kb_id}' is being built, retry later"}, 503
+
+    # --- НАЧАЛО ОСНОВНОЙ ЛОГИКИ АССИСТЕНТА ---
+    retrieved_context_text = None 
+    assistant_reply = None
+    
+    # 1. Получаем недавнюю историю чата для этого пользователя
+    #    n_turns=3 означает, что мы берем 3 последних "хода" (вопрос-ответ), т.е. 6 сообщений
+    recent_history = get_recent_history(user_id, n_turns=3, kb_id=kb_id) 
+    logger.debug(f"Извлеченная история для user_id '{user_id}': {recent_history}")
+
+    try:
+        logger.info(f"Ищем контекст для сообщения: '{user_message}'")
+        search_results = knowledge_base.search_similar(user_message, n_results=1)
+        distance_threshold = knowledge_base.distance_threshold
+
+        if search_results and search_results.get('documents') and search_results.get('distances'):
+            if search_results['distances'][0] and search_results['documents'][0]:
+                first_distance = search_results['distances'][0] 
+                first_document = search_results['documents'][0]
+                logger.info(f"Найден ближайший документ с дистанцией: {first_distance:.4f}")
+                if first_distance <= distance_threshold:
+                    retrieved_context_text = first_document
+                    logger.info(f"Релевантный контекст найден: '{retrieved_context_text}'")
+                else:
+                    logger.info(f"Найденный контекст нерелевантен (дистанция {first_distance:.4f} > {distance_threshold}).")
+            else:
+                logger.info("Внутренние списки distances/documents в результатах поиска пусты.")
+        else:
+            logger.info("Результаты поиска из векторной базы пусты или имеют неверный формат.")
+
+        # --- Формируем запрос к OpenAI ---
+        # Начинаем с системной инструкции
+        messages_for_openai = [{"role": "system", "content": knowledge_base.system_prompt}]
+        
+        # Добавляем извлеченную историю чата
+        messages_for_openai.extend(recent_history)
+        
+        # Формируем текущее сообщение пользователя, добавляя контекст, если он есть
+        current_user_prompt_content = ""
+        if retrieved_context_text:
+            current_user_prompt_content = f"Учитывая следующий контекст: \"{retrieved_context_text}\". Ответь на вопрос пользователя: \"{user_message}\""
+            logger.info("Контекст будет использован для OpenAI.")
+        else:
+            current_user_prompt_content = user_message
+            logger.info("Контекст не найден или нерелевантен. OpenAI будет вызван без дополнительного контекста из базы знаний (только с историей диалога, если есть).")
+
+        messages_for_openai.append({"role": "user", "content": current_user_prompt_content})
+        
+        # ВАЖНО: Решение о вызове OpenAI или передаче менеджеру
+        # Если даже с учетом истории диалога мы не нашли контекст из БАЗЫ ЗНАНИЙ для текущего вопроса,
+        # и если системный промт требует отвечать СТРОГО по базе знаний, то мы можем не вызывать OpenAI.
+        # Однако, если мы хотим, чтобы бот мог вести более свободный диалог или отвечать на общие фразы,
+        # опираясь на историю, то вызов OpenAI может быть полезен.
+        # Твой текущий system_prompt: "Отвечай только на основе информации из базы знаний."
+        # и "Если пользователь спрашивает вопрос, которого нет в базе знаний, отвечай: 'Извините, я не владею такой информацией...'"
+        # Это означает, что если retrieved_context_text НЕТ, то мы НЕ должны вызывать OpenAI для генерации ответа по теме.
+        
+        if retrieved_context_text: # Вызываем OpenAI только если есть релевантный контекст из БАЗЫ ЗНАНИЙ
+            try:
+                logger.info(f"Отправка запроса в OpenAI с моделью gpt-3.5-turbo. Сообщений в истории: {len(recent_history)}")
+                openai_response = openai.ChatCompletion.create(
+                    model="gpt-3.5-turbo", 
+                    messages=messages_for_openai,
+                    temperature=0.7,
+                    # Без таймаута зависший запрос держал бы задачу очереди (и ее аренду) бесконечно
+                    request_timeout=OPENAI_REQUEST_TIMEOUT
+                )
+                assistant_reply = openai_response.choices[0].message['content'].strip()
+                logger.info(f"Ответ от OpenAI получен: {assistant_reply}")
+            except Exception as openai_error:
+                logger.error(f"Ошибка при вызове OpenAI API: {openai_error}", exc_info=True)
+                assistant_reply = "Извините, произошла ошибка при обращении к AI-ассистенту. Попробуйте позже."
+        else: 
+            logger.info("Релевантный контекст из базы знаний не найден. Формируем ответ о передаче менеджеру.")
+            assistant_reply = "Извините, я не владею такой информацией по вашему вопросу. Ваш вопрос будет передан менеджеру, и он обязательно вам ответит."
+            # Вызываем отправку менеджеру
+            logger.info(f"Передаем вопрос менеджеру: '{user_message}' от пользователя {user_id} ({user_name})")
+            send_status = qa_bot_instance.send_to_manager(
+                question=user_message, 
+                user_id=user_id, # user_id уже строка 
+                user_name=user_name,
+                kb_id=kb_id
+            )
+            if send_status:
+                logger.info("Вопрос успешно поставлен в очередь на отправку менеджеру через Make.com.")
+            else:
+                logger.error("Не удалось поставить вопрос в очередь на отправку менеджеру через Make.com.")
+
+    except Exception as assistant_logic_error:
+        logger.error(f"Ошибка в основной логике ассистента: {assistant_logic_error}", exc_info=True)
+        assistant_reply = "Извините, произошла внутренняя ошибка при обработке вашего запроса."
+        # В этом случае, сохраняем вопрос пользователя, но ответ об ошибке
+        add_message_to_history(user_id, "user", user_message, kb_id=kb_id)
+        add_message_to_history(user_id, "assistant", assistant_reply, kb_id=kb_id)
+        return {"reply": assistant_reply, "error_details": str(assistant_logic_error)}, 500
+    
+    # --- Сохраняем текущий диалог в историю ---
+    # Сохраняем сообщение пользователя
+    add_message_to_history(user_id, "user", user_message, kb_id=kb_id)
+    # Сохраняем ответ ассистента, если он был сгенерирован
+    if assistant_reply:
+        add_message_to_history(user_id, "assistant", assistant_reply, kb_id=kb_id)
+    else: # На случай если assistant_reply по какой-то причине None
+        logger.error("assistant_reply is None перед финальным return. Это не должно было произойти.")
+        assistant_reply = "Не удалось обработать ваш запрос. Пожалуйста, попробуйте еще раз."
+        add_message_to_history(user_id, "assistant", assistant_reply, kb_id=kb_id) # Сохраняем и этот ответ
+
+    return {"reply": assistant_reply}, 200
+
+def handle_job(payload):
+    """Обработчик задачи из очереди асинхронного режима. Возвращает (результат, успех)."""
+    result, status_code = process_message(payload['user_id'], payload['user_name'], payload['message'],
+                                          kb_id=payload.get('kb_id', DEFAULT_KB_ID))
+    return result, status_code == 200
+
+# --- Очередь задач для асинхронного режима /webhook (async=true) ---
+# Задачи хранятся в той же SQLite базе, что и история, и переживают перезапуск процесса
+job_queue = JobQueue(db_path=DB_NAME, callback_enabled=bool(JOB_CALLBACK_URL))
+job_worker_pool = JobWorkerPool(job_queue, handle_job, callback_url=JOB_CALLBACK_URL, max_workers=JOB_WORKERS,
+                                retention_seconds=JOB_RETENTION_DAYS * 24 * 3600)
+if qa_bot_instance:
+    job_worker_pool.start()
+
 # --- Определяем маршрут для приема запросов от Make.com ---
 # В файле bot.py
 
@@ -226,121 +353,65 @@ def webhook():
         # Преобразуем user_id в строку сразу, так как он используется как TEXT в БД истории
         user_id = str(data.get('user_id', 'unknown')) 
         user_name = data.get('user_name', 'Пользователь')
+        # База знаний (бот/продукт), к которой относится сообщение
+        kb_id = str(data.get('kb_id') or DEFAULT_KB_ID)
 
         if not user_message:
             logger.warning("Получен webhook без поля 'message'.")
             return jsonify({"error": "No 'message' field provided in JSON"}), 400
 
-        logger.info(f"Получено сообщение на /webhook от пользователя {user_id} ({user_name}): {user_message}")
+        if kb_id not in qa_bot_instance.kb_registry:
+            logger.warning(f"Получен webhook с неизвестной базой знаний '{kb_id}'.")
+            return jsonify({"error": f"Unknown kb_id '{kb_id}'"}), 404
 
-        # --- НАЧАЛО ОСНОВНОЙ ЛОГИКИ АССИСТЕНТА ---
-        retrieved_context_text = None 
-        assistant_reply = None
-        
-        # 1. Получаем недавнюю историю чата для этого пользователя
-        #    n_turns=3 означает, что мы берем 3 последних "хода" (вопрос-ответ), т.е. 6 сообщений
-        recent_history = get_recent_history(user_id, n_turns=3) 
-        logger.debug(f"Извлеченная история для user_id '{user_id}': {recent_history}")
+        logger.info(f"Получено сообщение на /webhook от пользователя {user_id} ({user_name}) для базы знаний '{kb_id}': {user_message}")
 
-        try:
-            logger.info(f"Ищем контекст для сообщения: '{user_message}'")
-            search_results = qa_bot_instance.vector_store.search_similar(user_message, n_results=1)
-            distance_threshold = 0.3 
-
-            if search_results and search_results.get('documents') and search_results.get('distances'):
-                if search_results['distances'][0] and search_results['documents'][0]:
-                    first_distance = search_results['distances'][0] 
-                    first_document = search_results['documents'][0]
-                    logger.info(f"Найден ближайший документ с дистанцией: {first_distance:.4f}")
-                    if first_distance <= distance_threshold:
-                        retrieved_context_text = first_document
-                        logger.info(f"Релевантный контекст найден: '{retrieved_context_text}'")
-                    else:
-                        logger.info(f"Найденный контекст нерелевантен (дистанция {first_distance:.4f} > {distance_threshold}).")
-                else:
-                    logger.info("Внутренние списки distances/documents в результатах поиска пусты.")
-            else:
-                logger.info("Результаты поиска из векторной базы пусты или имеют неверный формат.")
-
-            # --- Формируем запрос к OpenAI ---
-            # Начинаем с системной инструкции
-            messages_for_openai = [{"role": "system", "content": SYSTEM_INSTRUCTIONS_TEXT}]
-            
-            # Добавляем извлеченную историю чата
-            messages_for_openai.extend(recent_history)
-            
-            # Формируем текущее сообщение пользователя, добавляя контекст, если он есть
-            current_user_prompt_content = ""
-            if retrieved_context_text:
-                current_user_prompt_content = f"Учитывая следующий контекст: \"{retrieved_context_text}\". Ответь на вопрос пользователя: \"{user_message}\""
-                logger.info("Контекст будет использован для OpenAI.")
-            else:
-                current_user_prompt_content = user_message
-                logger.info("Контекст не найден или нерелевантен. OpenAI будет вызван без дополнительного контекста из базы знаний (только с историей диалога, если есть).")
-
-            messages_for_openai.append({"role": "user", "content": current_user_prompt_content})
-            
-            # ВАЖНО: Решение о вызове OpenAI или передаче менеджеру
-            # Если даже с учетом истории диалога мы не нашли контекст из БАЗЫ ЗНАНИЙ для текущего вопроса,
-            # и если системный промт требует отвечать СТРОГО по базе знаний, то мы можем не вызывать OpenAI.
-            # Однако, если мы хотим, чтобы бот мог вести более свободный диалог или отвечать на общие фразы,
-            # опираясь на историю, то вызов OpenAI может быть полезен.
-            # Твой текущий system_prompt: "Отвечай только на основе информации из базы знаний."
-            # и "Если пользователь спрашивает вопрос, которого нет в базе знаний, отвечай: 'Извините, я не владею такой информацией...'"
-            # Это означает, что если retrieved_context_text НЕТ, то мы НЕ должны вызывать OpenAI для генерации ответа по теме.
-            
-            if retrieved_context_text: # Вызываем OpenAI только если есть релевантный контекст из БАЗЫ ЗНАНИЙ
-                try:
-                    logger.info(f"Отправка запроса в OpenAI с моделью gpt-3.5-turbo. Сообщений в истории: {len(recent_history)}")
-                    openai_response = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo", 
-                        messages=messages_for_openai,
-                        temperature=0.7 
-                    )
-                    assistant_reply = openai_response.choices[0].message['content'].strip()
-                    logger.info(f"Ответ от OpenAI получен: {assistant_reply}")
-                except Exception as openai_error:
-                    logger.error(f"Ошибка при вызове OpenAI API: {openai_error}", exc_info=True)
-                    assistant_reply = "Извините, произошла ошибка при обращении к AI-ассистенту. Попробуйте позже."
-            else: 
-                logger.info("Релевантный контекст из базы знаний не найден. Формируем ответ о передаче менеджеру.")
-                assistant_reply = "Извините, я не владею такой информацией по вашему вопросу. Ваш вопрос будет передан менеджеру, и он обязательно вам ответит."
-                # Вызываем отправку менеджеру
-                logger.info(f"Передаем вопрос менеджеру: '{user_message}' от пользователя {user_id} ({user_name})")
-                send_status = qa_bot_instance.send_to_manager(
-                    question=user_message, 
-                    user_id=user_id, # user_id уже строка 
-                    user_name=user_name
-                )
-                if send_status:
-                    logger.info("Вопрос успешно поставлен в очередь на отправку менеджеру через Make.com.")
-                else:
-                    logger.error("Не удалось поставить вопрос в очередь на отправку менеджеру через Make.com.")
-
-        except Exception as assistant_logic_error:
-            logger.error(f"Ошибка в основной логике ассистента: {assistant_logic_error}", exc_info=True)
-            assistant_reply = "Извините, произошла внутренняя ошибка при обработке вашего запроса."
-            # В этом случае, сохраняем вопрос пользователя, но ответ об ошибке
-            add_message_to_history(user_id, "user", user_message)
-            add_message_to_history(user_id, "assistant", assistant_reply)
-            return jsonify({"reply": assistant_reply, "error_details": str(assistant_logic_error)}), 500
-        
-        # --- Сохраняем текущий диалог в историю ---
-        # Сохраняем сообщение пользователя
-        add_message_to_history(user_id, "user", user_message)
-        # Сохраняем ответ ассистента, если он был сгенерирован
-        if assistant_reply:
-            add_message_to_history(user_id, "assistant", assistant_reply)
-        else: # На случай если assistant_reply по какой-то причине None
-            logger.error("assistant_reply is None перед финальным return. Это не должно было произойти.")
-            assistant_reply = "Не удалось обработать ваш запрос. Пожалуйста, попробуйте еще раз."
-            add_message_to_history(user_id, "assistant", assistant_reply) # Сохраняем и этот ответ
-
-        return jsonify({"reply": assistant_reply})
+        # Первая сборка базы идет в фоне; пока она не закончена, просим повторить запрос позже
+        if not qa_bot_instance.kb_registry.get(kb_id).is_available():
+            logger.warning(f"База знаний '{kb_id}' еще собирается. Запрос от пользователя {user_id} отклонен.")
+            return jsonify({"error": f"Knowledge base '{kb_id}' is being built, retry later"}), 503, {"Retry-After": "30"}
+
+        # Асинхронный режим: ставим задачу в очередь и сразу отвечаем 202, ответ уйдет на callback
+        if str(data.get('async', '')).lower() in ('true', '1'):
+            job_id = job_queue.enqueue({"user_id": user_id, "user_name": user_name, "message": user_message, "kb_id": kb_id})
+            job_worker_pool.notify()
+            logger.info(f"Сообщение от пользователя {user_id} поставлено в очередь как задача {job_id}.")
+            return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+        response_body, status_code = process_message(user_id, user_name, user_message, kb_id=kb_id)
+        return jsonify(response_body), status_code
 
     except Exception as e: 
         logger.error("Общая ошибка при обработке /webhook запроса:", exc_info=True)
         # На этом уровне ошибке не логируем user_message в историю, т.к. ошибка могла быть до его обработки
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Статус и результат задачи асинхронного режима."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    response_body = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "callback_status": job["callback_status"],
+        "created_at": datetime.datetime.utcfromtimestamp(job["created_at"]).isoformat() + "Z",
+        "updated_at": datetime.datetime.utcfromtimestamp(job["updated_at"]).isoformat() + "Z"
+    }
+    if job["result"]:
+        response_body.update(job["result"])
+    return jsonify(response_body)
+
+@app.route('/kb/<kb_id>/refresh', methods=['POST'])
+def refresh_kb(kb_id):
+    """Перезагружает базу знаний из Google Sheets в фоне; остальные базы продолжают отвечать."""
+    if not qa_bot_instance:
+        return jsonify({"error": "Внутренняя ошибка сервера: ассистент не инициализирован."}), 500
+    if kb_id not in qa_bot_instance.kb_registry:
+        return jsonify({"error": f"Unknown kb_id '{kb_id}'"}), 404
+    threading.Thread(target=qa_bot_instance.kb_registry.refresh, args=(kb_id,), name=f"kb-refresh-{kb_id}", daemon=True).start()
+    logger.info(f"Запущено обновление базы знаний '{kb_id}'.")
+    return jsonify({"kb_id": kb_id, "status": "refreshing"}), 202
+
 # ... (остальной код файла bot.py ниже остается без изменений)
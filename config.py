@@ -12,6 +12,31 @@ GOOGLE_SHEETS_ID = os.getenv('GOOGLE_SHEETS_ID')
 GOOGLE_CREDENTIALS = os.getenv('GOOGLE_CREDENTIALS')
 MANAGER_CHAT_ID = os.getenv('MANAGER_CHAT_ID')
 
+# Реестр баз знаний (JSON, см. knowledge_bases.example.json). Без файла работает одна база 'default'
+KB_REGISTRY_PATH = os.getenv('KB_REGISTRY_PATH', 'knowledge_bases.json')
+# Сколько баз знаний держать загруженными в памяти процесса одновременно (остальные вытесняются по LRU)
+KB_MAX_LOADED = int(os.getenv('KB_MAX_LOADED', '8'))
+
+# Асинхронный режим /webhook: URL сценария Make.com для готовых ответов и число воркеров на процесс
+JOB_CALLBACK_URL = os.getenv('MAKE_REPLY_WEBHOOK_URL')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Через сколько дней завершенные задачи (с доставленным результатом) удаляются из очереди
+JOB_RETENTION_DAYS = float(os.getenv('JOB_RETENTION_DAYS', '7'))
+# Таймаут запроса к OpenAI ChatCompletion (секунды): обработка задачи не должна зависать бесконечно
+OPENAI_REQUEST_TIMEOUT = int(os.getenv('OPENAI_REQUEST_TIMEOUT', '60'))
+
+# Провайдер эмбеддингов: 'openai' (по умолчанию), 'hashing' или 'sentence-transformers' (локально на CPU)
+EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'openai').strip().lower()
+# Имя модели для провайдера (необязательно, у каждого провайдера есть модель по умолчанию)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL') or None
+
+# Компактное хранение векторного индекса в памяти: '' (выключено), 'float16' или 'int8'.
+# Во включенном режиме полноточные векторы хранятся не в ChromaDB, а в файле db/vectors/<коллекция>.f32
+# (читается через mmap), поэтому переключение режима требует пересоздания коллекции.
+VECTOR_INDEX_MODE = os.getenv('VECTOR_INDEX_MODE', '').strip().lower()
+# Сколько кандидатов отбирать по квантованному индексу для точного переранжирования
+VECTOR_INDEX_CANDIDATES = int(os.getenv('VECTOR_INDEX_CANDIDATES', '16'))
+
 # Добавим проверку и логирование для удобства
 # Вместо print лучше использовать logging.warning или logging.error
 # Но print здесь для простоты и быстрого вывода
@@ -0,0 +1,215 @@
+import logging # Импортируем модуль логирования
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+import openai
+
+from config import OPENAI_API_KEY
+
+# Получаем логгер для этого модуля
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingProvider:
+    """
+    Базовый интерфейс провайдера эмбеддингов.
+
+    name и dimension записываются в метаданные коллекции, чтобы в одной коллекции
+    не оказались векторы разных моделей.
+    """
+    name = None
+    dimension = None
+    batch_size = 64
+    # Порог релевантности (квадрат L2-дистанции), подходящий провайдеру; None - порог базы знаний по умолчанию (0.3)
+    recommended_distance_threshold = None
+    # Повторные попытки для временных ошибок (сеть, лимиты API) на каждый батч
+    max_retries = 3
+    retry_delay = 1.0
+
+    def __init__(self):
+        self.is_ready = False
+
+    def _embed_batch(self, texts):
+        raise NotImplementedError
+
+    def ensure_dimension(self):
+        """
+        Возвращает размерность эмбеддингов. Если она заранее неизвестна (например, модель OpenAI
+        не из таблицы), определяет ее по реальному эмбеддингу. Возвращает None при ошибке.
+        """
+        if self.dimension is None and self.is_ready:
+            self.embed(["dimension probe"])
+        return self.dimension
+
+    def embed(self, texts):
+        """
+        Создание эмбеддингов для списка текстов (батчами по batch_size, с повторными попытками).
+        Возвращает список векторов (списки float) в том же порядке или None при ошибке.
+        """
+        if not self.is_ready:
+            return None
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self._embed_batch_with_retries(texts[start:start + self.batch_size])
+            if batch is None:
+                return None
+            embeddings.extend(batch)
+        return embeddings
+
+    def _embed_batch_with_retries(self, texts):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                embeddings = self._embed_batch(texts)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Ошибка при создании эмбеддингов провайдером '{self.name}' для {len(texts)} текстов: {e}", exc_info=True)
+                    return None
+                logger.warning(f"Попытка {attempt}/{self.max_retries} создания эмбеддингов провайдером '{self.name}' не удалась: {e}")
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+        # Размерность, записанная в метаданные коллекции, должна совпадать с реальной
+        if self.dimension is None:
+            self.dimension = len(embeddings[0])
+        if any(len(embedding) != self.dimension for embedding in embeddings):
+            logger.error(f"Провайдер '{self.name}' вернул эмбеддинги размерности, отличной от {self.dimension}.")
+            return None
+        return embeddings
+
+
+# Размерности известных моделей OpenAI; для остальных размерность определяется по первому эмбеддингу
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Эмбеддинги через OpenAI API (сетевой вызов на каждый батч)."""
+    # OpenAI принимает до 2048 текстов за один запрос, берем с запасом
+    batch_size = 100
+
+    def __init__(self, model="text-embedding-ada-002"):
+        super().__init__()
+        self.model = model
+        self.name = f"openai:{model}"
+        self.dimension = OPENAI_EMBEDDING_DIMENSIONS.get(model)
+        if not OPENAI_API_KEY:
+            logger.warning("OPENAI_API_KEY не установлен. Провайдер эмбеддингов OpenAI недоступен.")
+            return
+        openai.api_key = OPENAI_API_KEY
+        self.is_ready = True
+        logger.info(f"OpenAI API готов к работе с моделью: {self.model}")
+
+    def _embed_batch(self, texts):
+        response = openai.Embedding.create(input=texts, model=self.model)
+        # Ответ может прийти не в порядке входа, упорядочиваем по index
+        data = sorted(response['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Локальные эмбеддинги на CPU без внешних моделей: хэширование символьных n-грамм.
+
+    Каждая n-грамма отображается стабильным хэшем (crc32) в одну из dimension ячеек со знаком,
+    вектор нормируется по L2. Подходит для поиска перефразировок и опечаток,
+    но не понимает синонимы так, как нейросетевые модели.
+    Дистанции у него заметно больше, чем у нейросетевых моделей: перефразировки - примерно 0.3-1.4,
+    несвязанные вопросы - от 1.8, поэтому порог 0.3 для него не подходит.
+    """
+    batch_size = 256
+    recommended_distance_threshold = 1.0
+
+    def __init__(self, dimension=1024, ngram_range=(3, 5)):
+        super().__init__()
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+        self.name = f"hashing:char{ngram_range[0]}-{ngram_range[1]}"
+        self.is_ready = True
+        logger.info(f"Локальный провайдер эмбеддингов готов: {self.name}, размерность {self.dimension}")
+
+    def _ngrams(self, text):
+        # Нормализуем регистр и пробелы, границы слов помечаем пробелами
+        text = " " + re.sub(r"\s+", " ", text.lower()).strip() + " "
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                yield text[i:i + n]
+
+    def _embed_batch(self, texts):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for ngram in self._ngrams(text):
+                h = zlib.crc32(ngram.encode('utf-8'))
+                # Младшие биты - номер ячейки, старший бит - знак (снижает влияние коллизий)
+                vectors[row, h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms > 0, norms, 1.0)
+        return vectors.tolist()
+
+
+class SentenceTransformerEmbeddingProvider(EmbeddingProvider):
+    """
+    Локальные эмбеддинги на CPU моделью sentence-transformers.
+    Требует установленного пакета sentence-transformers; модель загружается один раз на процесс.
+    """
+    batch_size = 32
+
+    def __init__(self, model="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"):
+        super().__init__()
+        self.model_name = model
+        self.name = f"sentence-transformers:{model}"
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.error("Пакет sentence-transformers не установлен. Установите его: pip install sentence-transformers")
+            return
+        try:
+            self.model = SentenceTransformer(model, device="cpu")
+            self.dimension = self.model.get_sentence_embedding_dimension()
+            self.is_ready = True
+            logger.info(f"Модель эмбеддингов '{model}' загружена, размерность {self.dimension}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки модели эмбеддингов '{model}': {e}", exc_info=True)
+
+    def _embed_batch(self, texts):
+        vectors = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.tolist()
+
+
+# Доступные провайдеры по имени из конфигурации (EMBEDDING_PROVIDER)
+PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+    "sentence-transformers": SentenceTransformerEmbeddingProvider,
+}
+
+def recommended_distance_threshold(provider):
+    """Рекомендуемый порог релевантности для провайдера по имени или None, если подходит порог по умолчанию."""
+    provider_class = PROVIDERS.get(provider)
+    return provider_class.recommended_distance_threshold if provider_class else None
+
+
+# Провайдеры создаются (и модели загружаются) один раз на процесс
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_embedding_provider(provider="openai", model=None):
+    """
+    Возвращает общий для процесса экземпляр провайдера эмбеддингов.
+    model - имя модели для провайдеров, которые его поддерживают (openai, sentence-transformers).
+    """
+    if provider not in PROVIDERS:
+        raise ValueError(f"Неизвестный провайдер эмбеддингов '{provider}'. Допустимые значения: {', '.join(PROVIDERS)}")
+    key = (provider, model)
+    with _providers_lock:
+        if key not in _providers:
+            provider_class = PROVIDERS[provider]
+            _providers[key] = provider_class(model) if model and provider != "hashing" else provider_class()
+        return _providers[key]
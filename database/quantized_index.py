@@ -0,0 +1,200 @@
+import os # Для работы с путями
+import threading
+
+import numpy as np
+
+# Поддерживаемые режимы компактного хранения эмбеддингов
+QUANTIZATION_MODES = ("float16", "int8")
+# Размер блока строк при квантовании и распаковке кодов
+_BLOCK_ROWS = 1024
+
+
+class QuantizedIndex:
+    """
+    Компактный in-memory индекс эмбеддингов со скалярным квантованием.
+
+    Векторы хранятся в float16 или в int8 с отдельным масштабом для каждого вектора.
+    Поиск по индексу приблизительный и нужен только для отбора небольшого
+    набора кандидатов; точные дистанции считаются отдельно в exact_rerank()
+    по полноточным векторам, поэтому решение по порогу релевантности не меняется.
+
+    Состояние индекса (ids, коды, масштабы, нормы) публикуется одним присваиванием,
+    поэтому поиск во время add() видит либо старое, либо новое состояние целиком.
+    """
+
+    def __init__(self, mode="int8", dimension=None):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Неизвестный режим квантования '{mode}'. Допустимые значения: {', '.join(QUANTIZATION_MODES)}")
+        self.mode = mode
+        self.dimension = dimension
+        # (ids, квантованные векторы N x D, масштабы (N,) для int8 или None, квадраты норм (N,))
+        self._state = ((), None, None, None)
+        self._write_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._state[0])
+
+    @property
+    def ids(self):
+        return self._state[0]
+
+    def _quantize(self, vectors):
+        """Квантует матрицу векторов (N x D) блоками. Возвращает (codes, scales, sq_norms)."""
+        n_rows = vectors.shape[0]
+        codes = np.empty(vectors.shape, dtype=np.float16 if self.mode == "float16" else np.int8)
+        scales = np.empty(n_rows, dtype=np.float32) if self.mode == "int8" else None
+        sq_norms = np.empty(n_rows, dtype=np.float32)
+        for start in range(0, n_rows, _BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + _BLOCK_ROWS], dtype=np.float32)
+            end = start + len(block)
+            # Квадраты норм считаем по исходным векторам - это уменьшает ошибку оценки дистанции
+            sq_norms[start:end] = np.einsum('ij,ij->i', block, block)
+            if self.mode == "float16":
+                codes[start:end] = block
+            else:
+                # Симметричное int8-квантование: масштаб подбирается так, чтобы max|x| -> 127
+                max_abs = np.abs(block).max(axis=1)
+                block_scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+                codes[start:end] = np.clip(np.rint(block / block_scales[:, None]), -127, 127)
+                scales[start:end] = block_scales
+        return codes, scales, sq_norms
+
+    def add(self, ids, embeddings):
+        """
+        Добавление векторов в индекс.
+        ids - список строковых ID, embeddings - векторы (список списков float, массив или np.memmap).
+        """
+        if not len(ids):
+            return
+        vectors = embeddings if isinstance(embeddings, np.ndarray) else np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids):
+            raise ValueError("Количество ID не совпадает с количеством эмбеддингов.")
+
+        with self._write_lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Размерность эмбеддинга {vectors.shape[1]} не совпадает с размерностью индекса {self.dimension}.")
+
+            codes, scales, sq_norms = self._quantize(vectors)
+            old_ids, old_codes, old_scales, old_sq_norms = self._state
+            if old_codes is not None:
+                codes = np.concatenate([old_codes, codes])
+                sq_norms = np.concatenate([old_sq_norms, sq_norms])
+                if scales is not None:
+                    scales = np.concatenate([old_scales, scales])
+            self._state = (old_ids + tuple(ids), codes, scales, sq_norms)
+
+    def clear(self):
+        """Очистка индекса."""
+        with self._write_lock:
+            self._state = ((), None, None, None)
+
+    @staticmethod
+    def _approximate_distances(state, query):
+        """
+        Приблизительные квадраты L2-дистанций от запроса до всех векторов состояния
+        (та же метрика, что у коллекции ChromaDB по умолчанию).
+        """
+        ids, codes, scales, sq_norms = state
+        dots = np.empty(len(ids), dtype=np.float32)
+        # Распаковываем коды блоками: временный float32-буфер остается маленьким и помещается в кэш
+        for start in range(0, len(ids), _BLOCK_ROWS):
+            block = codes[start:start + _BLOCK_ROWS]
+            dots[start:start + len(block)] = block.astype(np.float32) @ query
+        if scales is not None:
+            dots *= scales
+        return sq_norms - 2.0 * dots + float(query @ query)
+
+    def candidates(self, query_embedding, n_candidates):
+        """
+        Возвращает список пар (номер строки, ID) для n_candidates ближайших
+        по приблизительной дистанции векторов, в порядке возрастания дистанции.
+        Номер строки совпадает с порядком добавления векторов в индекс.
+        """
+        state = self._state
+        ids = state[0]
+        if not ids:
+            return []
+        distances = self._approximate_distances(state, np.asarray(query_embedding, dtype=np.float32))
+        n_candidates = min(n_candidates, len(ids))
+        if n_candidates < len(ids):
+            top = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(distances[top])]
+        return [(int(row), ids[row]) for row in top]
+
+    def nbytes(self):
+        """Объем памяти, занимаемый массивами индекса (в байтах)."""
+        return sum(array.nbytes for array in self._state[1:] if array is not None)
+
+
+class VectorFile:
+    """
+    Полноточные (float32) векторы коллекции в файле на диске рядом с ChromaDB.
+
+    Файл только дописывается и читается через mmap: его страницы лежат в page cache ядра,
+    общем для всех процессов (воркеров gunicorn), и вытесняются при нехватке памяти,
+    а не копируются в частную память каждого процесса, как HNSW-сегмент ChromaDB.
+    Рядом лежит файл ID (по одному на строку); ID дописываются после векторов,
+    поэтому количество ID - это количество полностью записанных строк. Векторы сверх
+    этого количества (сбой между двумя записями) отбрасываются перед следующим добавлением.
+    """
+
+    def __init__(self, path, dimension):
+        self.vectors_path = f"{path}.f32"
+        self.ids_path = f"{path}.ids"
+        self.dimension = dimension
+        self._write_lock = threading.Lock()
+
+    def append(self, ids, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.shape != (len(ids), self.dimension):
+            raise ValueError(f"Ожидались векторы формы ({len(ids)}, {self.dimension}), получено {vectors.shape}.")
+        with self._write_lock:
+            os.makedirs(os.path.dirname(self.vectors_path), exist_ok=True)
+            committed_ids = self.read_ids()
+            # Строка i файла векторов должна соответствовать i-му ID: обрезаем оба файла до записанных целиком строк
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(len(committed_ids) * self.dimension * 4)
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_path, 'ab') as f:
+                f.truncate(sum(len(item_id.encode('utf-8')) + 1 for item_id in committed_ids))
+                f.write("".join(f"{item_id}\n" for item_id in ids).encode('utf-8'))
+
+    def read_ids(self):
+        if not os.path.exists(self.ids_path):
+            return []
+        with open(self.ids_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        # Последняя строка без перевода строки - недописанный ID
+        return content[:content.rfind("\n") + 1].splitlines()
+
+    def open(self, n_rows):
+        """Открывает первые n_rows векторов через mmap (только чтение). Возвращает None, если векторов нет."""
+        if n_rows == 0 or not os.path.exists(self.vectors_path):
+            return None
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n_rows, self.dimension))
+
+    def delete(self):
+        for path in (self.vectors_path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def exact_rerank(query_embedding, ids, embeddings, n_results):
+    """
+    Точное переранжирование кандидатов по полноточным векторам.
+    Возвращает список пар (id, квадрат L2-дистанции), отсортированный по возрастанию дистанции.
+    """
+    if not ids:
+        return []
+    query = np.asarray(query_embedding, dtype=np.float64)
+    vectors = np.asarray(embeddings, dtype=np.float64)
+    diffs = vectors - query
+    distances = np.einsum('ij,ij->i', diffs, diffs)
+    order = np.argsort(distances, kind='stable')[:n_results]
+    return [(ids[i], float(distances[i])) for i in order]
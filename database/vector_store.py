@@ -1,19 +1,77 @@
 import chromadb
 from chromadb.config import Settings
-import openai
+from chromadb.errors import InvalidCollectionException
+from chromadb.telemetry.product import ProductTelemetryClient
+from overrides import override
 import numpy as np
 import logging # Импортируем модуль логирования
 import os # Для работы с путями
-# Импортируем API ключ из config (убедитесь, что config.py находится в корне проекта)
-from config import OPENAI_API_KEY
+import shutil
+import threading
+from contextlib import contextmanager
+# Импортируем настройки из config (убедитесь, что config.py находится в корне проекта)
+from config import EMBEDDING_PROVIDER, EMBEDDING_MODEL, VECTOR_INDEX_MODE, VECTOR_INDEX_CANDIDATES
+from database.embeddings import EmbeddingProvider, get_embedding_provider
+from database.quantized_index import QUANTIZATION_MODES, QuantizedIndex, VectorFile, exact_rerank
 
 # Получаем логгер для этого модуля
 logger = logging.getLogger(__name__)
 
+# Провайдер, которым строились коллекции до появления метаданных о провайдере
+LEGACY_EMBEDDING_PROVIDER = "openai:text-embedding-ada-002"
+
+# Где хранятся полноточные векторы коллекции: в сегменте ChromaDB или в отдельном файле (режим квантованного индекса)
+STORAGE_CHROMA = "chroma"
+STORAGE_VECTOR_FILE = "vector_file"
+# В режиме vector_file ChromaDB хранит только документы и метаданные, а вместо вектора - эта заглушка
+PLACEHOLDER_EMBEDDING = [0.0]
+# Если батч эмбеддингов не создан, пары добавляются по одной; если подряд не удалось столько первых пар,
+# провайдер считается недоступным и остаток батча не перебирается
+FALLBACK_MAX_LEADING_FAILURES = 3
+
+# Сегменты ChromaDB общие для всех VectorStore одной коллекции в процессе (PersistentClient общий для каталога),
+# поэтому выгрузка сегментов откладывается, пока по коллекции выполняется хотя бы один запрос
+_usage_lock = threading.Lock()
+_collection_users = {}  # ID коллекции -> количество выполняющихся запросов
+_pending_release = {}   # ID коллекции -> VectorStore, ожидающие освобождения
+# Первое создание PersistentClient для каталога (миграции sysdb) не потокобезопасно
+_client_lock = threading.Lock()
+
+
+class _DisabledTelemetry(ProductTelemetryClient):
+    """
+    Телеметрия ChromaDB отключена. Пакетирование событий в chromadb 0.4.x не потокобезопасно:
+    при параллельных запросах collection.get()/query() падают с KeyError внутри телеметрии.
+    """
+
+    @override
+    def capture(self, event):
+        pass
+
+
+def _persistent_client(db_path):
+    """PersistentClient ChromaDB для каталога (один на процесс, ChromaDB кэширует его по пути)."""
+    with _client_lock:
+        return chromadb.PersistentClient(
+            path=db_path,
+            settings=Settings(anonymized_telemetry=False,
+                              chroma_product_telemetry_impl=f"{__name__}._DisabledTelemetry")
+        )
+
 
 class VectorStore:
-    def __init__(self, db_path="db"):
-        logger.info(f"Инициализация Vector Store в директории: {db_path}...")
+    def __init__(self, db_path="db", collection_name="qa_collection", index_mode=VECTOR_INDEX_MODE, index_candidates=VECTOR_INDEX_CANDIDATES,
+                 embedding_provider=EMBEDDING_PROVIDER, embedding_model=EMBEDDING_MODEL):
+        logger.info(f"Инициализация Vector Store в директории: {db_path}, коллекция: {collection_name}...")
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self.index = None
+        self.index_candidates = index_candidates
+        self.vector_file = None
+        self._vectors = None
+        # Запись в ChromaDB, VectorFile и индекс идет под одной блокировкой: номер строки в индексе
+        # должен совпадать с номером строки в VectorFile
+        self._write_lock = threading.Lock()
         # Убедимся, что директория для базы данных существует
         if not os.path.exists(db_path):
             os.makedirs(db_path)
@@ -22,107 +80,272 @@ class VectorStore:
         # Инициализация клиента ChromaDB
         # persist_directory указывает, где будут храниться файлы базы данных
         try:
-            self.client = chromadb.PersistentClient(path=db_path)
+            self.client = _persistent_client(db_path)
             # Получаем или создаем коллекцию для наших вопросов и ответов
-            self.collection = self.client.get_or_create_collection(name="qa_collection")
+            self.collection = self.client.get_or_create_collection(name=self.collection_name)
             logger.info("ChromaDB клиент и коллекция инициализированы.")
         except Exception as e:
             logger.error(f"Ошибка инициализации ChromaDB: {e}", exc_info=True)
             self.client = None
             self.collection = None
+            self.embedding_provider = None
+            self.is_embedding_ready = False
+            self.is_collection_compatible = False
             return # Прерываем инициализацию при ошибке
 
 
-        # Настройка API ключа OpenAI
-        if not OPENAI_API_KEY:
-             logger.warning("OPENAI_API_KEY не установлен. Функции создания эмбеддингов и поиска будут недоступны.")
-             self.embedding_model = None
-             self.is_openai_ready = False
-        else:
-            openai.api_key = OPENAI_API_KEY
-            # Выбор модели для создания эмбеддингов
-            # 'text-embedding-ada-002' - рекомендуемая модель от OpenAI для эмбеддингов
-            self.embedding_model = "text-embedding-ada-002"
-            self.is_openai_ready = True
-            logger.info(f"OpenAI API готов к работе с моделью: {self.embedding_model}")
-
+        # Провайдер эмбеддингов (общий для процесса, модель загружается один раз).
+        # Можно передать и готовый экземпляр EmbeddingProvider.
+        try:
+            if isinstance(embedding_provider, EmbeddingProvider):
+                self.embedding_provider = embedding_provider
+            else:
+                self.embedding_provider = get_embedding_provider(embedding_provider, embedding_model)
+        except ValueError as e:
+            logger.error(f"Ошибка выбора провайдера эмбеддингов: {e}")
+            self.embedding_provider = None
+        # Размерность нужна для метаданных коллекции; для неизвестных моделей она определяется пробным эмбеддингом
+        self.is_embedding_ready = bool(self.embedding_provider and self.embedding_provider.is_ready
+                                       and self.embedding_provider.ensure_dimension())
+        if not self.is_embedding_ready:
+            logger.warning("Провайдер эмбеддингов не готов. Функции создания эмбеддингов и поиска будут недоступны.")
+
+        # Компактный квантованный индекс (опционально). В этом режиме полноточные векторы не попадают
+        # в HNSW-сегмент ChromaDB (он целиком загружается в частную память каждого процесса), а лежат в VectorFile
+        # и читаются через mmap (общий для процессов page cache) только для переранжирования кандидатов.
+        if index_mode and index_mode not in QUANTIZATION_MODES:
+            logger.error(f"Неизвестный режим квантованного индекса '{index_mode}'. Векторы будут храниться в ChromaDB.")
+            index_mode = None
+        self.vector_storage = STORAGE_VECTOR_FILE if index_mode else STORAGE_CHROMA
+        if index_mode and self.is_embedding_ready:
+            self.index = QuantizedIndex(mode=index_mode, dimension=self.embedding_provider.dimension)
+            self.vector_file = VectorFile(os.path.join(db_path, "vectors", collection_name), self.embedding_provider.dimension)
+
+        # Коллекция должна быть построена тем же провайдером, той же размерностью и с тем же
+        # способом хранения векторов, иначе дистанции между векторами бессмысленны
+        self.is_collection_compatible = self.is_embedding_ready and self._check_collection_provider()
+
+        if self.index is not None and self.is_collection_compatible:
+            try:
+                self._load_index()
+            except Exception as e:
+                logger.error(f"Ошибка загрузки квантованного индекса ({index_mode}): {e}", exc_info=True)
+                self.is_collection_compatible = False
 
         logger.info("Vector Store инициализирован.")
 
+    @property
+    def is_ready(self):
+        """Готовность к добавлению данных и поиску."""
+        return bool(self.collection) and self.is_embedding_ready and self.is_collection_compatible
+
+    def _provider_metadata(self):
+        """Метаданные коллекции, описывающие провайдера эмбеддингов."""
+        return {
+            'embedding_provider': self.embedding_provider.name,
+            'embedding_dimension': self.embedding_provider.dimension,
+            'vector_storage': self.vector_storage
+        }
+
+    def _check_collection_provider(self):
+        """
+        Проверка, что коллекция построена текущим провайдером эмбеддингов.
+        Пустая коллекция (или коллекция без метаданных, построенная прежним провайдером по умолчанию)
+        помечается текущим провайдером. При несовпадении возвращает False: смешивать векторы нельзя.
+        """
+        expected = self._provider_metadata()
+        metadata = self.collection.metadata or {}
+        stored_provider = metadata.get('embedding_provider')
+
+        if stored_provider is None:
+            if self.collection.count() > 0 and (expected['embedding_provider'] != LEGACY_EMBEDDING_PROVIDER
+                                                or self.vector_storage != STORAGE_CHROMA):
+                logger.error(f"Коллекция построена провайдером {LEGACY_EMBEDDING_PROVIDER} с векторами в ChromaDB, "
+                             f"а настроен {expected['embedding_provider']} с хранением '{self.vector_storage}'. "
+                             "Поиск и добавление отключены до пересоздания коллекции (reset).")
+                return False
+            try:
+                self.collection.modify(metadata={**metadata, **expected})
+            except Exception as e:
+                logger.error(f"Не удалось записать метаданные провайдера в коллекцию: {e}", exc_info=True)
+            return True
+
+        if stored_provider != expected['embedding_provider'] or metadata.get('embedding_dimension') != expected['embedding_dimension']:
+            logger.error(f"Коллекция построена провайдером {stored_provider} (размерность {metadata.get('embedding_dimension')}), "
+                         f"а настроен {expected['embedding_provider']} (размерность {expected['embedding_dimension']}). "
+                         "Поиск и добавление отключены до пересоздания коллекции (reset).")
+            return False
+        stored_storage = metadata.get('vector_storage', STORAGE_CHROMA)
+        if stored_storage != self.vector_storage:
+            logger.error(f"Векторы коллекции хранятся как '{stored_storage}', а настроено '{self.vector_storage}' (VECTOR_INDEX_MODE). "
+                         "Поиск и добавление отключены до пересоздания коллекции (reset).")
+            return False
+        return True
+
+    def _load_index(self):
+        """
+        Заполнение квантованного индекса векторами из VectorFile коллекции.
+        Новый индекс строится целиком и подменяет прежний: поиски во время загрузки используют прежний.
+        """
+        index = QuantizedIndex(mode=self.index.mode, dimension=self.index.dimension)
+        ids = self.vector_file.read_ids()
+        vectors = self.vector_file.open(len(ids))
+        if vectors is not None:
+            index.add(ids, vectors)
+        # Отображение для переранжирования откроется при первом поиске
+        self.index, self._vectors = index, None
+        logger.info(f"Квантованный индекс ({self.index.mode}) загружен: {len(self.index)} векторов, {self.index.nbytes()} байт.")
+
     def create_embedding(self, text):
         """
-        Создание векторного представления (эмбеддинга) текста с помощью OpenAI API.
+        Создание векторного представления (эмбеддинга) текста настроенным провайдером.
         """
-        if not self.is_openai_ready:
-             # logger.error("OpenAI API не готов. Не могу создать эмбеддинг.") # Это может быть слишком много логов
+        if not self.is_embedding_ready:
+             # logger.error("Провайдер эмбеддингов не готов. Не могу создать эмбеддинг.") # Это может быть слишком много логов
              return None
 
         if not text or not isinstance(text, str):
              logger.warning("Попытка создать эмбеддинг для пустого или не строкового текста.")
              return None
 
-        try:
-            # OpenAI API принимает список текстов для создания эмбеддингов
-            response = openai.Embedding.create(
-                input=[text], # Передаем текст в виде списка
-                model=self.embedding_model
-            )
-            # Возвращаем векторное представление первого (и единственного) текста в списке
-            return response['data'][0]['embedding']
-        except Exception as e:
-            logger.error(f"Ошибка при создании эмбеддинга для текста '{text[:50]}...': {e}", exc_info=True)
+        embeddings = self.embedding_provider.embed([text])
+        if not embeddings:
+            logger.error(f"Ошибка при создании эмбеддинга для текста '{text[:50]}...'")
             return None
+        return embeddings[0]
 
     def add_qa_pair(self, question, answer, metadata=None):
         """
         Добавление пары вопрос-ответ в векторную базу.
         """
-        if not self.collection or not self.is_openai_ready:
-            # logger.error("Vector Store или OpenAI API не готовы. Не могу добавить пару.") # Слишком много логов
-            return
+        self.add_qa_pairs([(question, answer, metadata)])
 
-        if not question or not answer:
-             logger.warning("Попытка добавить пустой вопрос или ответ в базу.")
-             return
+    def add_qa_pairs(self, items, on_skipped=None):
+        """
+        Пакетное добавление пар вопрос-ответ в векторную базу.
+        items - список кортежей (вопрос, ответ, метаданные). Эмбеддинги создаются батчами.
+        Если батч не удался, его пары добавляются по одной; пары, для которых эмбеддинг так и не создан
+        (при том что остальные пары батча добавлены), пропускаются и передаются в on_skipped(item).
+        Возвращает количество добавленных пар.
+        """
+        if not self.is_ready:
+            # logger.error("Vector Store или провайдер эмбеддингов не готовы. Не могу добавить пары.") # Слишком много логов
+            return 0
 
-        # Создаем эмбеддинг для вопроса
-        embedding = self.create_embedding(question)
-        if embedding is None:
-             logger.error(f"Не удалось добавить пару: {question} / {answer[:50]}... из-за ошибки создания эмбеддинга.")
-             return
+        valid_items = []
+        for question, answer, metadata in items:
+            if not question or not answer:
+                logger.warning("Попытка добавить пустой вопрос или ответ в базу.")
+                continue
+            valid_items.append((question, answer, metadata))
+        if not valid_items:
+            return 0
+
+        # Эмбеддинги создаются и записываются батчами: ошибка в одном батче не теряет остальные
+        added = 0
+        batch_size = self.embedding_provider.batch_size
+        for start in range(0, len(valid_items), batch_size):
+            added += self._add_batch(valid_items[start:start + batch_size], on_skipped)
+        if added < len(valid_items):
+            logger.error(f"Добавлено {added} из {len(valid_items)} пар: часть пар не записана из-за ошибок.")
+        return added
+
+    def _add_batch(self, batch, on_skipped=None):
+        """Создает эмбеддинги для батча пар и записывает их в коллекцию. Возвращает количество добавленных пар."""
+        embeddings = self.embedding_provider.embed([question for question, _, _ in batch])
+        if embeddings is None:
+            if len(batch) > 1:
+                logger.warning(f"Не удалось создать эмбеддинги для батча из {len(batch)} пар, добавляем пары по одной.")
+                return self._add_one_by_one(batch, on_skipped)
+            logger.error(f"Не удалось добавить {len(batch)} пар из-за ошибки создания эмбеддингов.")
+            return 0
 
+        with self._write_lock:
+            return self._write_batch(batch, embeddings)
+
+    def _add_one_by_one(self, batch, on_skipped):
+        added = 0
+        failed = []
+        for item in batch:
+            if not added and len(failed) >= FALLBACK_MAX_LEADING_FAILURES:
+                logger.error(f"Провайдер эмбеддингов недоступен: не добавлено ни одной из первых {len(failed)} пар батча.")
+                return 0
+            embeddings = self.embedding_provider.embed([item[0]])
+            if embeddings is None:
+                failed.append(item)
+                continue
+            with self._write_lock:
+                added += self._write_batch([item], embeddings)
+        if not added:
+            logger.error(f"Не удалось добавить {len(batch)} пар из-за ошибки создания эмбеддингов.")
+            return 0
+        # Остальные пары батча добавлены - значит, провайдер отклоняет именно эти вопросы
+        for item in failed:
+            logger.error(f"Пара пропущена: не удалось создать эмбеддинг для вопроса '{item[0][:50]}...'")
+            if on_skipped is not None:
+                on_skipped(item)
+        return added
+
+    def _write_batch(self, batch, embeddings):
+        # Вызывается под self._write_lock
         try:
-            # Генерируем уникальный ID для каждого элемента
-            # Можно использовать хэш вопроса или просто счетчик
-            # Пока используем простой ID на основе количества элементов в коллекции
+            # Генерируем уникальный ID для каждого элемента: порядковый номер в коллекции + хэш вопроса
             # Важно: ID должен быть строкой! Убедимся, что ID уникален
-            item_id = f"qa_{self.collection.count() + 1}_{abs(hash(question))}" # Добавляем хэш для уникальности
+            base_count = self.collection.count()
+            item_ids = [f"qa_{base_count + i + 1}_{abs(hash(question))}" for i, (question, _, _) in enumerate(batch)]
             # Простая проверка на дубликаты ID (не гарантирует 100% уникальности при параллельных запросах, но для простоты достаточно)
-            existing_ids = self.collection.get(ids=[item_id]).get('ids', [])
-            if item_id in existing_ids:
-                 item_id = f"qa_{self.collection.count() + 1}_{abs(hash(question))}_{np.random.randint(1000)}" # Добавляем случайное число если ID уже есть
-                 logger.warning(f"Дубликат ID '{existing_ids[0]}' при добавлении '{question[:50]}...'. Сгенерирован новый ID: '{item_id}'")
-
-
-            # Добавляем данные в коллекцию ChromaDB
-            self.collection.add(
-                embeddings=[embedding],      # Список эмбеддингов (один элемент)
-                documents=[answer],          # Список документов (ответов)
-                metadatas=[metadata] if metadata else [{}], # Список метаданных (если есть)
-                ids=[item_id]               # Список уникальных ID
-            )
-            # logger.info(f"Добавлена пара: '{question[:50]}...'") # Слишком много логов
+            taken_ids = set(self.collection.get(ids=item_ids).get('ids', []))
+            for i, item_id in enumerate(item_ids):
+                if item_id in taken_ids:
+                    item_ids[i] = f"{item_id}_{np.random.randint(1000)}" # Добавляем случайное число если ID уже есть
+                    logger.warning(f"Дубликат ID '{item_id}' при добавлении '{batch[i][0][:50]}...'. Сгенерирован новый ID: '{item_ids[i]}'")
+                taken_ids.add(item_ids[i])
+
+            # В режиме vector_file в ChromaDB - только документы и заглушка вместо вектора
+            chroma_embeddings = [PLACEHOLDER_EMBEDDING] * len(item_ids) if self.vector_storage == STORAGE_VECTOR_FILE else embeddings
+
+            # Добавляем данные в коллекцию ChromaDB. ChromaDB не принимает пустые метаданные ({} или None в списке),
+            # поэтому пары с метаданными и без них записываются отдельными вызовами
+            with_metadata = [i for i, (_, _, metadata) in enumerate(batch) if metadata]
+            without_metadata = [i for i, (_, _, metadata) in enumerate(batch) if not metadata]
+            try:
+                for positions in (with_metadata, without_metadata):
+                    if not positions:
+                        continue
+                    self.collection.add(
+                        embeddings=[chroma_embeddings[i] for i in positions],
+                        documents=[batch[i][1] for i in positions],
+                        metadatas=[batch[i][2] for i in positions] if positions is with_metadata else None,
+                        ids=[item_ids[i] for i in positions]
+                    )
+            except Exception:
+                # Частично записанный батч убираем, чтобы не оставить документы без векторов
+                self.collection.delete(ids=item_ids)
+                raise
+            if self.vector_storage == STORAGE_VECTOR_FILE:
+                # Полноточные векторы дописываются только после успешной записи в ChromaDB,
+                # иначе в файле остались бы векторы без документов
+                try:
+                    self.vector_file.append(item_ids, embeddings)
+                except Exception:
+                    self.collection.delete(ids=item_ids)
+                    raise
+            if self.index is not None:
+                self.index.add(item_ids, embeddings)
+                # Файл вырос - отображение для переранжирования откроется заново при следующем поиске
+                self._vectors = None
+            return len(item_ids)
         except Exception as e:
-             logger.error(f"Ошибка при добавлении пары '{question[:50]}...' в ChromaDB: {e}", exc_info=True)
-
+             logger.error(f"Ошибка при добавлении {len(batch)} пар в ChromaDB: {e}", exc_info=True)
+             return 0
 
     def search_similar(self, query, n_results=1):
         """
         Поиск наиболее похожих вопросов в базе по запросу.
         Возвращает список найденных документов (ответов) и метаданных.
         """
-        if not self.collection or not self.is_openai_ready:
-            logger.warning("Vector Store или OpenAI API не готовы. Не могу выполнить поиск.")
+        if not self.is_ready:
+            logger.warning("Vector Store или провайдер эмбеддингов не готовы. Не могу выполнить поиск.")
             return {'documents': [], 'metadatas': [], 'distances': [], 'ids': []}
 
         if not query or not isinstance(query, str):
@@ -136,10 +359,18 @@ class VectorStore:
              logger.error("Не удалось выполнить поиск из-за ошибки создания эмбеддинга запроса.")
              return {'documents': [], 'metadatas': [], 'distances': [], 'ids': []}
 
+        with self._in_use():
+            if self.vector_storage == STORAGE_VECTOR_FILE:
+                return self._search_quantized(query, query_embedding, n_results)
+            return self._search_chroma(query, query_embedding, n_results)
+
+    def _search_chroma(self, query, query_embedding, n_results):
+        """Поиск по HNSW-индексу коллекции ChromaDB."""
         try:
             # Выполняем поиск в коллекции
             # include=['metadatas', 'documents', 'distances'] - явно указываем, что нужно вернуть
-            results = self.collection.query(
+            results = self._collection_call(
+                'query',
                 query_embeddings=[query_embedding], # Список эмбеддингов запросов (один элемент)
                 n_results=n_results,                # Количество результатов, которые хотим получить
                 include=['metadatas', 'documents', 'distances']
@@ -160,6 +391,110 @@ class VectorStore:
              logger.error(f"Ошибка при поиске в ChromaDB для запроса '{query[:50]}...': {e}", exc_info=True)
              return {'documents': [], 'metadatas': [], 'distances': [], 'ids': []}
 
+    def _search_quantized(self, query, query_embedding, n_results):
+        """
+        Поиск через квантованный индекс: отбор кандидатов по сжатым векторам
+        и точное переранжирование по полноточным векторам из VectorFile (mmap).
+        Дистанции - точные квадраты L2, как у collection.query(), поэтому порог релевантности работает так же.
+        """
+        try:
+            # Индекс и VectorFile принадлежат конкретной коллекции: если ее пересоздали (reset() в другом
+            # VectorStore или процессе), старые номера строк в новом файле векторов не имеют смысла
+            current = self.client.get_collection(name=self.collection_name)
+            if current.id != self.collection.id:
+                logger.warning(f"Коллекция '{self.collection_name}' была пересоздана, перезагружаем квантованный индекс.")
+                self._switch_collection(current)
+            index = self.index
+            candidates = index.candidates(query_embedding, max(n_results, self.index_candidates))
+            if not candidates:
+                return {'documents': [], 'metadatas': [], 'distances': [], 'ids': []}
+            vectors = self._vectors
+            if vectors is None or len(vectors) < len(index):
+                vectors = self._vectors = self.vector_file.open(len(index))
+            rows = [row for row, _ in candidates]
+            ranked = exact_rerank(query_embedding, [item_id for _, item_id in candidates], vectors[rows], n_results)
+
+            # Документы и метаданные берем из ChromaDB только для итоговых результатов
+            found = self._collection_call('get', ids=[item_id for item_id, _ in ranked], include=['documents', 'metadatas'])
+            position = {item_id: i for i, item_id in enumerate(found['ids'])}
+            ranked = [(item_id, distance) for item_id, distance in ranked if item_id in position]
+
+            return {
+                'ids': [item_id for item_id, _ in ranked],
+                'documents': [found['documents'][position[item_id]] for item_id, _ in ranked],
+                'metadatas': [found['metadatas'][position[item_id]] for item_id, _ in ranked],
+                'distances': [distance for _, distance in ranked]
+            }
+
+        except Exception as e:
+             logger.error(f"Ошибка при поиске по квантованному индексу для запроса '{query[:50]}...': {e}", exc_info=True)
+             return {'documents': [], 'metadatas': [], 'distances': [], 'ids': []}
+
+    def _collection_call(self, method, **kwargs):
+        """
+        Вызов метода коллекции ChromaDB. Если коллекцию удалили и создали заново (например, reset()
+        в другом процессе), объект коллекции ссылается на старый ID: получаем коллекцию по имени
+        и повторяем вызов один раз.
+        """
+        try:
+            return getattr(self.collection, method)(**kwargs)
+        except (InvalidCollectionException, StopIteration):
+            logger.warning(f"Коллекция '{self.collection_name}' была пересоздана или удалена, получаем ее заново.")
+            self._switch_collection(self.client.get_collection(name=self.collection_name))
+            return getattr(self.collection, method)(**kwargs)
+
+    def _switch_collection(self, collection):
+        """Переход на пересозданную коллекцию с тем же именем."""
+        with self._write_lock:
+            if collection.id == self.collection.id:
+                return  # Уже перешли в другом потоке
+            self.collection = collection
+            self.is_collection_compatible = self.is_embedding_ready and self._check_collection_provider()
+            if self.index is not None and self.is_collection_compatible:
+                # Векторы новой коллекции лежат в новом VectorFile
+                self._load_index()
+
+    @contextmanager
+    def _in_use(self):
+        """Отмечает коллекцию как используемую на время запроса: release() дождется его завершения."""
+        collection_id = self.collection.id
+        with _usage_lock:
+            _collection_users[collection_id] = _collection_users.get(collection_id, 0) + 1
+        try:
+            yield
+        finally:
+            with _usage_lock:
+                _collection_users[collection_id] -= 1
+                if not _collection_users[collection_id]:
+                    del _collection_users[collection_id]
+                    # Выгрузка под _usage_lock: новый запрос не начнется, пока сегменты останавливаются
+                    for vector_store in _pending_release.pop(collection_id, []):
+                        vector_store._release_now()
+
+    def release(self):
+        """
+        Освобождает память, занятую коллекцией в этом процессе: квантованный индекс и загруженные
+        ChromaDB сегменты (HNSW-индекс целиком лежит в памяти). При следующем обращении к коллекции
+        ChromaDB загрузит сегменты с диска заново.
+        Если по коллекции в этот момент выполняются запросы, память освобождается после завершения последнего из них.
+        """
+        if not self.collection:
+            self._release_now()
+            return
+        with _usage_lock:
+            if _collection_users.get(self.collection.id):
+                _pending_release.setdefault(self.collection.id, []).append(self)
+                logger.info(f"Выгрузка коллекции '{self.collection_name}' отложена до завершения выполняющихся запросов.")
+                return
+            self._release_now()
+
+    def _release_now(self):
+        if self.index is not None:
+            self.index.clear()
+            self._vectors = None
+        if self.collection:
+            _release_segments(self.client, self.collection.id, self.collection_name)
+
     def count(self):
         """
         Получение количества элементов в коллекции.
@@ -167,7 +502,8 @@ class VectorStore:
         if not self.collection:
             return 0
         try:
-            return self.collection.count()
+            with self._in_use():
+                return self._collection_call('count')
         except Exception as e:
             logger.error(f"Ошибка при получении количества элементов в ChromaDB: {e}")
             return 0
@@ -180,13 +516,83 @@ class VectorStore:
          if not self.client:
              logger.error("ChromaDB клиент не инициализирован. Не могу сбросить коллекцию.")
              return
-         try:
-             self.client.delete_collection(name="qa_collection")
-             # После удаления нужно создать коллекцию заново
-             self.collection = self.client.get_or_create_collection(name="qa_collection")
-             logger.info("Коллекция 'qa_collection' сброшена.")
-         except Exception as e:
-             logger.error(f"Ошибка при сбросе коллекции ChromaDB: {e}")
+         with self._write_lock:
+             try:
+                 self.client.delete_collection(name=self.collection_name)
+                 # После удаления нужно создать коллекцию заново
+                 # Новая коллекция помечается текущим провайдером эмбеддингов
+                 metadata = self._provider_metadata() if self.is_embedding_ready else None
+                 self.collection = self.client.get_or_create_collection(name=self.collection_name, metadata=metadata)
+                 self.is_collection_compatible = self.is_embedding_ready
+                 if self.index is not None:
+                     self.index.clear()
+                     self._vectors = None
+                     self.vector_file.delete()
+                 logger.info(f"Коллекция '{self.collection_name}' сброшена.")
+             except Exception as e:
+                 logger.error(f"Ошибка при сбросе коллекции ChromaDB: {e}")
+
+
+def _release_segments(client, collection_id, collection_name):
+    """
+    Выгружает загруженные сегменты коллекции из памяти процесса.
+
+    В chromadb 0.4.x нет публичного API для выгрузки коллекции, поэтому используются внутренние
+    структуры LocalSegmentManager; если их нет (другая версия chromadb), сегменты остаются в памяти.
+    """
+    try:
+        manager = client._server._manager
+        with manager._lock:
+            segments = manager._segment_cache.pop(collection_id, {})
+            for segment in segments.values():
+                instance = manager._instances.pop(segment["id"], None)
+                if instance is not None:
+                    instance.stop()
+            file_handles = getattr(manager, "_vector_instances_file_handle_cache", None)
+            if file_handles is not None:
+                vector_instance = file_handles.cache.pop(collection_id, None)
+                if vector_instance is not None:
+                    vector_instance.close_persistent_index()
+        logger.info(f"Сегменты коллекции '{collection_name}' выгружены из памяти.")
+    except AttributeError as e:
+        logger.warning(f"Не удалось выгрузить сегменты коллекции '{collection_name}' (несовместимая версия chromadb): {e}")
+
+
+def collection_count(db_path, collection_name):
+    """Количество элементов в коллекции ChromaDB или 0, если коллекции нет."""
+    try:
+        return _persistent_client(db_path).get_collection(name=collection_name).count()
+    except ValueError:
+        return 0
+
+
+def _segment_ids(client, collection_id):
+    """ID сегментов коллекции (внутренний API chromadb 0.4.x; пустой список, если он недоступен)."""
+    try:
+        return [segment["id"] for segment in client._server._sysdb.get_segments(collection=collection_id)]
+    except AttributeError as e:
+        logger.warning(f"Не удалось получить сегменты коллекции (несовместимая версия chromadb): {e}")
+        return []
+
+
+def delete_collection(db_path, collection_name):
+    """Удаляет коллекцию ChromaDB вместе с каталогами ее сегментов и файлом полноточных векторов (если он есть)."""
+    segment_ids = []
+    try:
+        client = _persistent_client(db_path)
+        segment_ids = _segment_ids(client, client.get_collection(name=collection_name).id)
+        client.delete_collection(name=collection_name)
+    except ValueError:
+        logger.info(f"Коллекция '{collection_name}' не найдена, удалять нечего.")
+    except Exception as e:
+        logger.error(f"Ошибка при удалении коллекции '{collection_name}': {e}", exc_info=True)
+        segment_ids = []
+    # ChromaDB удаляет каталог HNSW-сегмента, только если сегмент загружен в этом процессе
+    for segment_id in segment_ids:
+        segment_path = os.path.join(db_path, str(segment_id))
+        if os.path.isdir(segment_path):
+            shutil.rmtree(segment_path, ignore_errors=True)
+    VectorFile(os.path.join(db_path, "vectors", collection_name), dimension=None).delete()
 
 
 # Пример использования (можно удалить после тестирования)
@@ -207,7 +613,7 @@ class VectorStore:
 
 #         vector_db = VectorStore(db_path="db")
 
-#         if vector_db.is_openai_ready and vector_db.collection:
+#         if vector_db.is_ready:
 #             logger.info("\nДобавление тестовых данных:")
 #             # Добавляем тестовые данные (можно из Google Sheets загрузить)
 #             vector_db.add_qa_pair("Как работает сервис?", "Наш сервис предоставляет услуги ...")
@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from utils.job_queue import (CALLBACK_DELIVERED, CALLBACK_FAILED, CALLBACK_PENDING, STATUS_DONE, STATUS_FAILED,
+                             STATUS_QUEUED, STATUS_RUNNING, JobQueue, JobWorkerPool)
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "jobs.db")
+        self.queue = JobQueue(db_path=self.db_path, lease_seconds=60, max_attempts=2, callback_enabled=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def set_fields(self, job_id, **fields):
+        """Меняет поля задачи напрямую в базе (например, чтобы "состарить" аренду без ожидания)."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            assignments = ", ".join(f"{name} = ?" for name in fields)
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class TestClaim(JobQueueTestCase):
+    def test_claim_returns_job_once(self):
+        job_id = self.queue.enqueue({"message": "привет"})
+        claimed_id, token, payload = self.queue.claim_next()
+        self.assertEqual(claimed_id, job_id)
+        self.assertEqual(payload, {"message": "привет"})
+        self.assertEqual(self.queue.get(job_id)["status"], STATUS_RUNNING)
+        self.assertIsNone(self.queue.claim_next())
+
+    def test_concurrent_claims_do_not_share_jobs(self):
+        for i in range(20):
+            self.queue.enqueue({"n": i})
+        claimed, lock = [], threading.Lock()
+
+        def worker():
+            while True:
+                job = self.queue.claim_next()
+                if job is None:
+                    return
+                with lock:
+                    claimed.append(job[0])
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 20)
+        self.assertEqual(len(set(claimed)), 20)
+
+
+class TestLease(JobQueueTestCase):
+    def test_expired_lease_is_taken_over_and_stale_finish_rejected(self):
+        job_id = self.queue.enqueue({})
+        _, first_token, _ = self.queue.claim_next()
+        self.set_fields(job_id, updated_at=time.time() - 61)
+
+        _, second_token, _ = self.queue.claim_next()
+        self.assertNotEqual(first_token, second_token)
+        self.assertFalse(self.queue.finish(job_id, first_token, STATUS_DONE, result={"answer": "старый"}))
+        self.assertTrue(self.queue.finish(job_id, second_token, STATUS_DONE, result={"answer": "новый"}))
+
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], STATUS_DONE)
+        self.assertEqual(job["result"], {"answer": "новый"})
+        self.assertEqual(job["attempts"], 2)
+
+    def test_heartbeat_keeps_lease(self):
+        job_id = self.queue.enqueue({})
+        _, token, _ = self.queue.claim_next()
+        self.set_fields(job_id, updated_at=time.time() - 61)
+        self.assertTrue(self.queue.heartbeat(job_id, token))
+        self.assertIsNone(self.queue.claim_next())
+
+    def test_heartbeat_with_foreign_token_fails(self):
+        job_id = self.queue.enqueue({})
+        self.queue.claim_next()
+        self.assertFalse(self.queue.heartbeat(job_id, "чужой"))
+
+    def test_exhausted_job_fails_with_callback(self):
+        job_id = self.queue.enqueue({})
+        for _ in range(2):
+            self.queue.claim_next()
+            self.set_fields(job_id, updated_at=time.time() - 61)
+        self.assertIsNone(self.queue.claim_next())
+
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], STATUS_FAILED)
+        self.assertEqual(job["callback_status"], CALLBACK_PENDING)
+        self.assertEqual(self.queue.claim_callback()["status"], STATUS_FAILED)
+
+
+class TestCallbacks(JobQueueTestCase):
+    def finished_job(self, result=None):
+        job_id = self.queue.enqueue({"user_id": "42", "user_name": "Иван", "kb_id": "default"})
+        _, token, _ = self.queue.claim_next()
+        self.queue.finish(job_id, token, STATUS_DONE, result=result or {"answer": "ответ"})
+        return job_id
+
+    def test_claimed_callback_is_hidden_from_other_workers(self):
+        self.finished_job()
+        self.assertIsNotNone(self.queue.claim_callback())
+        self.assertIsNone(self.queue.claim_callback())
+
+    def test_no_callback_when_disabled(self):
+        queue = JobQueue(db_path=self.db_path, callback_enabled=False)
+        job_id = queue.enqueue({})
+        _, token, _ = queue.claim_next()
+        queue.finish(job_id, token, STATUS_DONE, result={})
+        self.assertIsNone(queue.get(job_id)["callback_status"])
+        self.assertIsNone(queue.claim_callback())
+
+    def test_callback_retried_then_delivered(self):
+        job_id = self.finished_job()
+        pool = JobWorkerPool(self.queue, handler=None, callback_url="http://callback", callback_retry_delay=0)
+
+        with mock.patch("utils.job_queue.requests.post", side_effect=requests.exceptions.ConnectionError("нет сети")):
+            pool._send_callback(self.queue.claim_callback())
+        job = self.queue.get(job_id)
+        self.assertEqual(job["callback_status"], CALLBACK_PENDING)
+        self.assertEqual(job["callback_attempts"], 1)
+
+        with mock.patch("utils.job_queue.requests.post") as post:
+            pool._send_callback(self.queue.claim_callback())
+        sent = post.call_args.kwargs["json"]
+        self.assertEqual(sent["job_id"], job_id)
+        self.assertEqual(sent["answer"], "ответ")
+        self.assertEqual(sent["kb_id"], "default")
+        self.assertEqual(self.queue.get(job_id)["callback_status"], CALLBACK_DELIVERED)
+        self.assertIsNone(self.queue.claim_callback())
+
+    def test_callback_retry_is_delayed(self):
+        self.finished_job()
+        pool = JobWorkerPool(self.queue, handler=None, callback_url="http://callback", callback_retry_delay=60)
+        with mock.patch("utils.job_queue.requests.post", side_effect=requests.exceptions.Timeout()):
+            pool._send_callback(self.queue.claim_callback())
+        self.assertIsNone(self.queue.claim_callback())
+
+    def test_callback_gives_up_after_retries(self):
+        job_id = self.finished_job()
+        pool = JobWorkerPool(self.queue, handler=None, callback_url="http://callback",
+                             callback_retries=2, callback_retry_delay=0)
+        with mock.patch("utils.job_queue.requests.post", side_effect=requests.exceptions.Timeout()):
+            pool._send_callback(self.queue.claim_callback())
+            pool._send_callback(self.queue.claim_callback())
+        self.assertEqual(self.queue.get(job_id)["callback_status"], CALLBACK_FAILED)
+        self.assertIsNone(self.queue.claim_callback())
+
+
+class TestPurge(JobQueueTestCase):
+    def test_purge_removes_only_old_settled_jobs(self):
+        def finish(callback_status):
+            job_id = self.queue.enqueue({})
+            _, token, _ = self.queue.claim_next()
+            self.queue.finish(job_id, token, STATUS_DONE, result={})
+            self.set_fields(job_id, callback_status=callback_status, updated_at=time.time() - 3600)
+            return job_id
+
+        delivered = finish(CALLBACK_DELIVERED)
+        undeliverable = finish(CALLBACK_FAILED)
+        no_callback = finish(None)
+        pending = finish(CALLBACK_PENDING)
+        recent = finish(CALLBACK_DELIVERED)
+        self.set_fields(recent, updated_at=time.time())
+        queued = self.queue.enqueue({})
+        self.set_fields(queued, updated_at=time.time() - 3600)
+
+        self.assertEqual(self.queue.purge(older_than_seconds=60), 3)
+        for job_id in (delivered, undeliverable, no_callback):
+            self.assertIsNone(self.queue.get(job_id))
+        self.assertEqual(self.queue.get(pending)["callback_status"], CALLBACK_PENDING)
+        self.assertIsNotNone(self.queue.get(recent))
+        self.assertEqual(self.queue.get(queued)["status"], STATUS_QUEUED)
+
+
+class TestWorkerPool(JobQueueTestCase):
+    def test_callbacks_are_delivered_while_jobs_keep_coming(self):
+        for i in range(5):
+            self.queue.enqueue({"n": i})
+        posted = []
+
+        def post(url, json, timeout):
+            posted.append(json)
+            return mock.Mock(status_code=200)
+
+        def handler(payload):
+            # Под нагрузкой в очереди все время есть новые задачи
+            self.queue.enqueue({"n": payload["n"] + 5})
+            return {"answer": str(payload["n"])}, True
+
+        pool = JobWorkerPool(self.queue, handler, callback_url="http://callback", max_workers=1, poll_interval=0.05)
+        with mock.patch("utils.job_queue.requests.post", side_effect=post):
+            pool.start()
+            deadline = time.time() + 5
+            while len(posted) < 3 and time.time() < deadline:
+                time.sleep(0.02)
+            pool.stop()
+            pool._threads[0].join(timeout=5)
+        self.assertGreaterEqual(len(posted), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
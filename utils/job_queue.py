@@ -0,0 +1,384 @@
+import json
+import logging # Импортируем модуль логирования
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+# Получаем логгер для этого модуля
+logger = logging.getLogger(__name__)
+
+# Статусы задач
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Статусы доставки результата на callback
+CALLBACK_PENDING = "pending"
+CALLBACK_DELIVERED = "delivered"
+CALLBACK_FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Локальная персистентная очередь задач на SQLite.
+
+    Задачи и недоставленные callback-и переживают перезапуск процесса. Задача в статусе running,
+    по которой владелец не продлевал аренду lease_seconds (например, упал воркер gunicorn),
+    снова выдается в работу; результат сохраняет только текущий владелец задачи (claim_token).
+    """
+
+    def __init__(self, db_path="chat_history.db", lease_seconds=300, max_attempts=3, callback_enabled=False):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Если True, для завершенных задач ставится в очередь доставка результата на callback
+        self.callback_enabled = callback_enabled
+        self._init_db()
+
+    def _connect(self):
+        # Отдельное соединение на каждую операцию: очередь используется из нескольких потоков и процессов
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    claim_token TEXT,
+                    callback_status TEXT,
+                    callback_attempts INTEGER NOT NULL DEFAULT 0,
+                    callback_next_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # Миграция баз, созданных до появления владельца задачи и очереди callback-ов
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column, definition in (("claim_token", "TEXT"),
+                                       ("callback_attempts", "INTEGER NOT NULL DEFAULT 0"),
+                                       ("callback_next_at", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_callback ON jobs (callback_status, callback_next_at)")
+            conn.commit()
+            logger.info(f"Очередь задач инициализирована в базе '{self.db_path}'.")
+        finally:
+            conn.close()
+
+    def enqueue(self, payload):
+        """Добавляет задачу в очередь. Возвращает ID задачи."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("""
+                INSERT INTO jobs (id, payload, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (job_id, json.dumps(payload, ensure_ascii=False), STATUS_QUEUED, now, now))
+            conn.commit()
+        finally:
+            conn.close()
+        logger.debug(f"Задача {job_id} поставлена в очередь.")
+        return job_id
+
+    def _callback_fields(self, now):
+        # (callback_status, callback_next_at) для только что завершенной задачи
+        return (CALLBACK_PENDING, now) if self.callback_enabled else (None, None)
+
+    def claim_next(self):
+        """
+        Атомарно забирает следующую задачу в работу.
+        Возвращает (job_id, claim_token, payload) или None, если очередь пуста.
+        Задачи, исчерпавшие попытки, по пути отмечаются как failed (с доставкой на callback).
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE берет блокировку на запись: одна задача не достанется двум воркерам
+            conn.execute("BEGIN IMMEDIATE")
+            while True:
+                row = conn.execute("""
+                    SELECT id, payload, attempts FROM jobs
+                    WHERE status = ? OR (status = ? AND updated_at < ?)
+                    ORDER BY created_at
+                    LIMIT 1
+                """, (STATUS_QUEUED, STATUS_RUNNING, now - self.lease_seconds)).fetchone()
+                if row is None:
+                    conn.commit()
+                    return None
+                if row["attempts"] < self.max_attempts:
+                    break
+                result = {"error": "Job processing attempts exceeded"}
+                conn.execute("""
+                    UPDATE jobs SET status = ?, result = ?, error = ?, claim_token = NULL,
+                                    callback_status = ?, callback_next_at = ?, updated_at = ?
+                    WHERE id = ?
+                """, (STATUS_FAILED, json.dumps(result), "Превышено количество попыток обработки",
+                      *self._callback_fields(now), now, row["id"]))
+                logger.error(f"Задача {row['id']} отмечена как failed: превышено количество попыток ({self.max_attempts}).")
+            claim_token = uuid.uuid4().hex
+            conn.execute("UPDATE jobs SET status = ?, claim_token = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                         (STATUS_RUNNING, claim_token, now, row["id"]))
+            conn.commit()
+            return row["id"], claim_token, json.loads(row["payload"])
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id, claim_token):
+        """Продлевает аренду задачи. Возвращает False, если задача уже принадлежит другому воркеру."""
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND claim_token = ? AND status = ?",
+                                  (time.time(), job_id, claim_token, STATUS_RUNNING))
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def finish(self, job_id, claim_token, status, result=None, error=None):
+        """
+        Сохраняет результат задачи (status - STATUS_DONE или STATUS_FAILED).
+        Возвращает False, если аренда истекла и задачу уже забрал другой воркер - тогда результат не сохраняется.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute("""
+                UPDATE jobs SET status = ?, result = ?, error = ?, claim_token = NULL,
+                                callback_status = ?, callback_next_at = ?, updated_at = ?
+                WHERE id = ? AND claim_token = ? AND status = ?
+            """, (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                  *self._callback_fields(now), now, job_id, claim_token, STATUS_RUNNING))
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def claim_callback(self):
+        """
+        Атомарно забирает следующий результат, который пора доставить на callback.
+        На время доставки результат скрывается от других воркеров на lease_seconds.
+        Возвращает словарь (id, status, payload, result, callback_attempts) или None.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""
+                SELECT id, status, payload, result, callback_attempts FROM jobs
+                WHERE callback_status = ? AND callback_next_at <= ?
+                ORDER BY callback_next_at
+                LIMIT 1
+            """, (CALLBACK_PENDING, now)).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute("UPDATE jobs SET callback_next_at = ? WHERE id = ?", (now + self.lease_seconds, row["id"]))
+            conn.commit()
+        finally:
+            conn.close()
+        callback = dict(row)
+        callback["payload"] = json.loads(callback["payload"])
+        callback["result"] = json.loads(callback["result"]) if callback["result"] else {}
+        return callback
+
+    def callback_delivered(self, job_id):
+        self._update_callback(job_id, CALLBACK_DELIVERED, None)
+
+    def callback_failed(self, job_id, retry_at=None):
+        """Записывает неудачную попытку доставки: повтор в retry_at или окончательный отказ, если retry_at=None."""
+        self._update_callback(job_id, CALLBACK_PENDING if retry_at is not None else CALLBACK_FAILED, retry_at)
+
+    def _update_callback(self, job_id, callback_status, callback_next_at):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                UPDATE jobs SET callback_status = ?, callback_next_at = ?, callback_attempts = callback_attempts + 1
+                WHERE id = ?
+            """, (callback_status, callback_next_at, job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def purge(self, older_than_seconds):
+        """
+        Удаляет завершенные (done/failed) задачи старше older_than_seconds, результат которых
+        уже доставлен на callback, окончательно не доставлен или не требует доставки.
+        Возвращает количество удаленных задач.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute("""
+                DELETE FROM jobs
+                WHERE status IN (?, ?) AND updated_at < ?
+                  AND (callback_status IS NULL OR callback_status IN (?, ?))
+            """, (STATUS_DONE, STATUS_FAILED, time.time() - older_than_seconds, CALLBACK_DELIVERED, CALLBACK_FAILED))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        """Возвращает задачу в виде словаря или None, если задача не найдена."""
+        conn = self._connect()
+        try:
+            row = conn.execute("""
+                SELECT id, status, result, error, attempts, callback_status, callback_attempts, created_at, updated_at
+                FROM jobs WHERE id = ?
+            """, (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class JobWorkerPool:
+    """
+    Пул потоков, обрабатывающих задачи из JobQueue с ограниченной конкурентностью.
+
+    handler(payload) должен вернуть (result, ok). Результат сохраняется в очереди
+    и доставляется POST-запросом на callback_url (если он задан). Доставка тоже идет
+    через очередь: неудачные попытки повторяются с растущей задержкой, не занимая воркер.
+    Завершенные задачи удаляются из очереди через retention_seconds (None - не удаляются).
+    """
+
+    def __init__(self, queue, handler, callback_url=None, max_workers=2, poll_interval=2.0,
+                 callback_timeout=10, callback_retries=5, callback_retry_delay=5.0,
+                 retention_seconds=7 * 24 * 3600, purge_interval=3600):
+        self.queue = queue
+        self.handler = handler
+        self.callback_url = callback_url
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.callback_timeout = callback_timeout
+        self.callback_retries = callback_retries
+        self.callback_retry_delay = callback_retry_delay
+        self.retention_seconds = retention_seconds
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._purge_lock = threading.Lock()
+        # Аренду задачи продлеваем заметно чаще, чем она истекает
+        self.heartbeat_interval = max(queue.lease_seconds / 3, 1.0)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Пул обработки задач запущен: {self.max_workers} воркеров.")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def notify(self):
+        """Будит воркеры после постановки новой задачи, не дожидаясь poll_interval."""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim_next()
+                if job is not None:
+                    self._process(*job)
+                # После каждой задачи доставляем не больше одного callback-а, которому пора:
+                # под постоянной нагрузкой доставка не откладывается до опустошения очереди задач
+                callback = self.queue.claim_callback() if self.callback_url else None
+                if callback is not None:
+                    self._send_callback(callback)
+                self._purge_if_due()
+                if job is not None or callback is not None:
+                    continue
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при работе с очередью задач: {e}", exc_info=True)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _purge_if_due(self):
+        if self.retention_seconds is None:
+            return
+        # Очистку выполняет один воркер не чаще раза в purge_interval
+        with self._purge_lock:
+            now = time.time()
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+        deleted = self.queue.purge(self.retention_seconds)
+        if deleted:
+            logger.info(f"Из очереди удалено завершенных задач: {deleted}.")
+
+    def _heartbeat(self, job_id, claim_token, done):
+        while not done.wait(self.heartbeat_interval):
+            try:
+                if not self.queue.heartbeat(job_id, claim_token):
+                    logger.warning(f"Аренда задачи {job_id} потеряна: задача передана другому воркеру.")
+                    return
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при продлении аренды задачи {job_id}: {e}", exc_info=True)
+
+    def _process(self, job_id, claim_token, payload):
+        logger.info(f"Обработка задачи {job_id}...")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, claim_token, done),
+                                     name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+        heartbeat.start()
+        error = None
+        try:
+            result, ok = self.handler(payload)
+            status = STATUS_DONE if ok else STATUS_FAILED
+        except Exception as e:
+            logger.error(f"Ошибка при обработке задачи {job_id}: {e}", exc_info=True)
+            status, result, error = STATUS_FAILED, {"error": "Internal server error"}, str(e)
+        finally:
+            done.set()
+        if self.queue.finish(job_id, claim_token, status, result=result, error=error):
+            logger.info(f"Задача {job_id} завершена со статусом {status}.")
+        else:
+            logger.warning(f"Результат задачи {job_id} отброшен: аренда истекла и задача передана другому воркеру.")
+
+    def _send_callback(self, callback):
+        job_id = callback["id"]
+        payload = callback["payload"]
+        callback_payload = {
+            "job_id": job_id,
+            "status": callback["status"],
+            "user_id": payload.get("user_id"),
+            "user_name": payload.get("user_name"),
+            "kb_id": payload.get("kb_id"),
+            **callback["result"]
+        }
+        attempt = callback["callback_attempts"] + 1
+        try:
+            response = requests.post(self.callback_url, json=callback_payload, timeout=self.callback_timeout)
+            response.raise_for_status()
+            self.queue.callback_delivered(job_id)
+            logger.info(f"Результат задачи {job_id} отправлен на callback. Статус: {response.status_code}")
+            return
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Попытка {attempt}/{self.callback_retries} отправки результата задачи {job_id} не удалась: {e}")
+        if attempt < self.callback_retries:
+            self.queue.callback_failed(job_id, retry_at=time.time() + self.callback_retry_delay * 2 ** (attempt - 1))
+        else:
+            self.queue.callback_failed(job_id)
+            logger.error(f"Не удалось отправить результат задачи {job_id} на callback {self.callback_url}.")
@@ -0,0 +1,482 @@
+import json
+import logging # Импортируем модуль логирования
+import os # Для работы с путями
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+from config import EMBEDDING_PROVIDER
+from database.embeddings import recommended_distance_threshold
+from database.vector_store import VectorStore, collection_count, delete_collection
+
+# Получаем логгер для этого модуля
+logger = logging.getLogger(__name__)
+
+DEFAULT_KB_ID = "default"
+# Пути к файлам системных промтов в реестре указываются относительно корня проекта (как в bot.load_system_instructions)
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# База знаний по умолчанию - то, что бот обслуживал до появления реестра
+DEFAULT_KB_SETTINGS = {
+    "range": "Регистрация ТМ!A:D",
+    "collection": "qa_collection",
+    "system_prompt_file": "system_prompt.txt",
+    "distance_threshold": 0.3
+}
+
+# Имя коллекции ChromaDB: 3-63 символа [a-zA-Z0-9._-], по краям буква или цифра, без '..', не IPv4-адрес.
+# К имени из реестра при каждой пересборке добавляется суффикс версии, поэтому базовое имя короче на его длину
+_COLLECTION_NAME_RE = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]*[a-zA-Z0-9]$")
+_IPV4_RE = re.compile(r"^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$")
+_VERSION_SUFFIX_LENGTH = 9  # "_" + 8 hex-символов
+MAX_COLLECTION_NAME_LENGTH = 63 - _VERSION_SUFFIX_LENGTH
+
+# Аренда пересборки базы одним процессом: сборщик продлевает ее каждую треть срока,
+# а аренда упавшего сборщика освобождается не позже чем через этот срок
+BUILD_LEASE_SECONDS = 120
+# Как часто фоновая первая синхронизация проверяет, не закончил ли сборку другой процесс
+BUILD_WAIT_INTERVAL = 5.0
+# Через сколько секунд повторить неудачную первую синхронизацию (например, таблица недоступна)
+INITIAL_SYNC_RETRY_INTERVAL = 300.0
+
+
+def is_valid_collection_name(name):
+    """Проверка базового имени коллекции по правилам ChromaDB (с учетом суффикса версии)."""
+    return (isinstance(name, str) and 3 <= len(name) <= MAX_COLLECTION_NAME_LENGTH
+            and bool(_COLLECTION_NAME_RE.match(name)) and ".." not in name and not _IPV4_RE.match(name))
+
+
+def load_kb_settings(registry_path):
+    """
+    Читает реестр баз знаний из JSON-файла вида {"kb_id": {"range": ..., "collection": ...,
+    "system_prompt_file": ..., "distance_threshold": ...}, ...}.
+    Если файла нет, возвращает одну базу знаний DEFAULT_KB_ID с настройками по умолчанию.
+    Порог релевантности по умолчанию зависит от провайдера эмбеддингов (EMBEDDING_PROVIDER).
+    """
+    provider_threshold = recommended_distance_threshold(EMBEDDING_PROVIDER)
+    default_threshold = provider_threshold or DEFAULT_KB_SETTINGS["distance_threshold"]
+    if provider_threshold:
+        logger.warning(f"Провайдер эмбеддингов '{EMBEDDING_PROVIDER}': порог релевантности по умолчанию {provider_threshold} "
+                       f"вместо {DEFAULT_KB_SETTINGS['distance_threshold']}.")
+
+    if not registry_path or not os.path.exists(registry_path):
+        logger.info(f"Файл реестра баз знаний не найден ({registry_path}). Используется одна база знаний '{DEFAULT_KB_ID}'.")
+        return {DEFAULT_KB_ID: {**DEFAULT_KB_SETTINGS, "distance_threshold": default_threshold}}
+
+    with open(registry_path, 'r', encoding='utf-8') as f:
+        raw_settings = json.load(f)
+
+    kb_settings = {}
+    for kb_id, settings in raw_settings.items():
+        if not settings.get("range"):
+            logger.error(f"В реестре у базы знаний '{kb_id}' не указан диапазон таблицы ('range'). База пропущена.")
+            continue
+        collection = settings.get("collection")
+        if collection is None:
+            # Имя по умолчанию строится из kb_id; если kb_id не подходит для ChromaDB (например, кириллица), берем хэш
+            collection = f"qa_{kb_id}"
+            if not is_valid_collection_name(collection):
+                collection = f"qa_{zlib.crc32(kb_id.encode('utf-8')):08x}"
+        elif not is_valid_collection_name(collection):
+            logger.error(f"У базы знаний '{kb_id}' недопустимое имя коллекции '{collection}': нужно 3-{MAX_COLLECTION_NAME_LENGTH} "
+                         "символов a-z, A-Z, 0-9, '.', '_', '-', по краям буква или цифра. База пропущена.")
+            continue
+        system_prompt_file = settings.get("system_prompt_file", DEFAULT_KB_SETTINGS["system_prompt_file"])
+        if not os.path.isfile(os.path.join(PROJECT_DIR, system_prompt_file)):
+            # Без своего промта бот отвечал бы по этой базе с инструкциями по умолчанию
+            logger.error(f"У базы знаний '{kb_id}' не найден файл системного промта '{system_prompt_file}'. База пропущена.")
+            continue
+        kb_settings[kb_id] = {
+            "range": settings["range"],
+            "collection": collection,
+            "system_prompt_file": system_prompt_file,
+            "distance_threshold": float(settings.get("distance_threshold", default_threshold))
+        }
+        if provider_threshold and kb_settings[kb_id]["distance_threshold"] < provider_threshold / 2:
+            logger.warning(f"У базы знаний '{kb_id}' порог релевантности {kb_settings[kb_id]['distance_threshold']} намного ниже "
+                           f"рекомендованного для провайдера '{EMBEDDING_PROVIDER}' ({provider_threshold}): "
+                           "почти все вопросы будут передаваться менеджеру.")
+    logger.info(f"Реестр баз знаний загружен из {registry_path}: {', '.join(kb_settings) or 'пусто'}.")
+    return kb_settings
+
+
+class CollectionPointers:
+    """
+    Указатели на активные версии коллекций баз знаний (SQLite-файл в каталоге ChromaDB).
+
+    Общие для всех процессов: база пересобирается в новую коллекцию одним процессом
+    (аренда сборки), после чего указатель переключается одним UPDATE. Предыдущая версия
+    сохраняется, чтобы запросы, начатые до переключения, успели завершиться.
+    """
+
+    def __init__(self, db_path, build_lease_seconds=BUILD_LEASE_SECONDS):
+        os.makedirs(db_path, exist_ok=True)
+        self.path = os.path.join(db_path, "kb_collections.db")
+        self.build_lease_seconds = build_lease_seconds
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS kb_collections (
+                    kb_id TEXT PRIMARY KEY,
+                    collection TEXT,
+                    previous TEXT,
+                    build_token TEXT,
+                    build_until REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def active(self, kb_id):
+        """Имя активной версии коллекции базы знаний или None, если база еще ни разу не собиралась."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT collection FROM kb_collections WHERE kb_id = ?", (kb_id,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def claim_build(self, kb_id):
+        """Занимает пересборку базы. Возвращает токен сборки или None, если базу уже собирает другой процесс."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO kb_collections (kb_id, updated_at) VALUES (?, ?)", (kb_id, now))
+            cursor = conn.execute("""
+                UPDATE kb_collections SET build_token = ?, build_until = ?
+                WHERE kb_id = ? AND (build_token IS NULL OR build_until < ?)
+            """, (token, now + self.build_lease_seconds, kb_id, now))
+            conn.commit()
+        finally:
+            conn.close()
+        return token if cursor.rowcount == 1 else None
+
+    def renew_build(self, kb_id, token):
+        """Продлевает аренду сборки. Возвращает False, если сборку уже забрал другой процесс."""
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE kb_collections SET build_until = ? WHERE kb_id = ? AND build_token = ?",
+                                  (time.time() + self.build_lease_seconds, kb_id, token))
+            conn.commit()
+        finally:
+            conn.close()
+        return cursor.rowcount == 1
+
+    def switch(self, kb_id, token, collection, fallback_previous=None):
+        """
+        Атомарно делает collection активной версией, если сборка все еще принадлежит token.
+        Возвращает (успех, коллекция, которую больше никто не использует и можно удалить).
+        fallback_previous - коллекция, которая считается предыдущей версией при первом переключении.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT collection, previous FROM kb_collections WHERE kb_id = ? AND build_token = ?",
+                               (kb_id, token)).fetchone()
+            if row is None:
+                conn.commit()
+                return False, None
+            active, stale = row
+            conn.execute("""
+                UPDATE kb_collections SET collection = ?, previous = ?, build_token = NULL, build_until = NULL, updated_at = ?
+                WHERE kb_id = ?
+            """, (collection, active or fallback_previous, time.time(), kb_id))
+            conn.commit()
+        finally:
+            conn.close()
+        return True, stale
+
+    def release_build(self, kb_id, token):
+        """Освобождает пересборку без переключения (например, после ошибки)."""
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE kb_collections SET build_token = NULL, build_until = NULL WHERE kb_id = ? AND build_token = ?",
+                         (kb_id, token))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class KnowledgeBase:
+    """
+    Одна загруженная база знаний: свой системный промт, порог релевантности и коллекция.
+    Коллекция версионирована: search_similar() всегда ищет в активной версии из CollectionPointers.
+    """
+
+    def __init__(self, kb_id, settings, system_prompt, db_path, pointers):
+        self.kb_id = kb_id
+        self.range_name = settings["range"]
+        self.base_collection = settings["collection"]
+        self.distance_threshold = settings["distance_threshold"]
+        self.system_prompt = system_prompt
+        self.db_path = db_path
+        self.pointers = pointers
+        self._vector_store = None
+        # Сколько поисков сейчас идет в каждой версии VectorStore: замененная или вытесненная версия
+        # освобождается только после завершения последнего из них
+        self._store_users = {}
+        self._released = False
+        self._store_lock = threading.Lock()
+        # Есть ли данные в коллекции из реестра, заполненной до версионирования (проверяется один раз)
+        self._has_legacy_data = None
+
+    def is_available(self):
+        """Есть ли в базе данные для поиска: активная версия или коллекция из реестра, заполненная до версионирования."""
+        if self.pointers.active(self.kb_id) is not None:
+            return True
+        if self._has_legacy_data is None:
+            self._has_legacy_data = collection_count(self.db_path, self.base_collection) > 0
+        return self._has_legacy_data
+
+    def search_similar(self, query, n_results=1):
+        """Поиск в активной версии коллекции; после пересборки (в любом процессе) используется новая версия."""
+        # Пока база ни разу не собиралась, используется коллекция с именем из реестра (данные до версионирования)
+        collection = self.pointers.active(self.kb_id) or self.base_collection
+        retired = None
+        with self._store_lock:
+            if self._vector_store is None or self._vector_store.collection_name != collection:
+                retired = self._swap_store(VectorStore(db_path=self.db_path, collection_name=collection))
+            vector_store = self._vector_store
+            self._store_users[vector_store] = self._store_users.get(vector_store, 0) + 1
+        self._release_store(retired)
+        try:
+            return vector_store.search_similar(query, n_results=n_results)
+        finally:
+            self._release_store(self._finish_use(vector_store))
+
+    def _swap_store(self, vector_store):
+        # Вызывается под self._store_lock. Возвращает прежнюю версию, если ее можно освободить сразу;
+        # иначе ее освободит последний использующий ее поиск (см. _finish_use)
+        previous, self._vector_store = self._vector_store, vector_store
+        if previous is None or previous is vector_store or self._store_users.get(previous):
+            return None
+        return previous
+
+    def _finish_use(self, vector_store):
+        """Отмечает завершение поиска. Возвращает версию, которую пора освободить, или None."""
+        with self._store_lock:
+            self._store_users[vector_store] -= 1
+            if self._store_users[vector_store]:
+                return None
+            del self._store_users[vector_store]
+            if vector_store is not self._vector_store:
+                return vector_store
+            if self._released:
+                # База вытеснена во время поиска: версия, открытая этим поиском, освобождается им же
+                self._vector_store = None
+                return vector_store
+            return None
+
+    @staticmethod
+    def _release_store(vector_store):
+        if vector_store is not None:
+            vector_store.release()
+
+    def release(self):
+        """Освобождает память, занятую коллекцией в этом процессе (при вытеснении из реестра)."""
+        with self._store_lock:
+            self._released = True
+            retired = self._swap_store(None)
+        self._release_store(retired)
+
+    def rebuild(self, sheets_manager):
+        """
+        Пересобирает базу из Google Sheets в новую версию коллекции и переключается на нее.
+        Пока идет сборка, запросы обслуживает прежняя версия. Переключение происходит только
+        если в новую версию записаны все строки, кроме отклоненных провайдером эмбеддингов.
+        Возвращает False, если базу уже пересобирает другой процесс.
+        """
+        token = self.pointers.claim_build(self.kb_id)
+        if token is None:
+            return False
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_build, args=(token, done), name=f"kb-build-{self.kb_id}", daemon=True)
+        heartbeat.start()
+        collection = f"{self.base_collection}_{uuid.uuid4().hex[:8]}"
+        try:
+            vector_store = self._build(sheets_manager, collection)
+            if vector_store is None:
+                delete_collection(self.db_path, collection)
+                return True
+            switched, stale = self.pointers.switch(self.kb_id, token, collection, fallback_previous=self.base_collection)
+            if not switched:
+                logger.error(f"[{self.kb_id}] Аренда сборки истекла до переключения, версия '{collection}' отброшена.")
+                vector_store.release()
+                delete_collection(self.db_path, collection)
+                return True
+            logger.info(f"[{self.kb_id}] Активная версия коллекции: '{collection}' ({vector_store.count()} элементов).")
+            with self._store_lock:
+                # База могла быть вытеснена из реестра, пока собиралась
+                retired = self._swap_store(vector_store) if not self._released else vector_store
+            self._release_store(retired)
+            if stale and stale != collection:
+                delete_collection(self.db_path, stale)
+                logger.info(f"[{self.kb_id}] Устаревшая версия коллекции '{stale}' удалена.")
+            return True
+        finally:
+            done.set()
+            self.pointers.release_build(self.kb_id, token)
+
+    def _renew_build(self, token, done):
+        # Аренду сборки продлеваем заметно чаще, чем она истекает
+        while not done.wait(self.pointers.build_lease_seconds / 3):
+            try:
+                if not self.pointers.renew_build(self.kb_id, token):
+                    logger.warning(f"[{self.kb_id}] Аренда сборки потеряна: базу пересобирает другой процесс.")
+                    return
+            except sqlite3.Error as e:
+                logger.error(f"[{self.kb_id}] Ошибка при продлении аренды сборки: {e}", exc_info=True)
+
+    def _build(self, sheets_manager, collection):
+        """Заполняет новую коллекцию данными из Google Sheets. Возвращает VectorStore или None при ошибке."""
+        logger.info(f"[{self.kb_id}] Начало загрузки данных из Google Sheets ({self.range_name}) в коллекцию '{collection}'...")
+        qa_data_df = sheets_manager.get_qa_data(range_name=self.range_name)
+
+        if qa_data_df.empty:
+            logger.warning(f"[{self.kb_id}] Не удалось загрузить данные из Google Sheets или таблица пуста. Версия не переключена.")
+            return None
+
+        logger.info(f"[{self.kb_id}] Прочитано {len(qa_data_df)} строк из Google Sheets. Начинаем добавление в векторную базу.")
+        qa_pairs = []
+        for index, row in qa_data_df.iterrows():
+            question = row.get('Вопрос')
+            answer = row.get('Ответ')
+            category = row.get('Категория', 'general')
+
+            if question and answer:
+                metadata = {'category': category}
+                qa_pairs.append((question, answer, metadata))
+            else:
+                logger.warning(f"[{self.kb_id}] Пропущена строка {index + 2} в Google Sheets из-за отсутствия вопроса или ответа: {row.to_dict()}")
+
+        vector_store = VectorStore(db_path=self.db_path, collection_name=collection)
+        # Эмбеддинги создаются батчами, а не отдельным запросом на каждую строку
+        skipped = []
+        added = vector_store.add_qa_pairs(qa_pairs, on_skipped=skipped.append)
+        if not added or added < len(qa_pairs) - len(skipped):
+            logger.error(f"[{self.kb_id}] В новую версию записано {added} из {len(qa_pairs)} пар. Версия не переключена.")
+            vector_store.release()
+            return None
+        if skipped:
+            logger.warning(f"[{self.kb_id}] Пропущено {len(skipped)} пар, отклоненных провайдером эмбеддингов: "
+                           f"{', '.join(repr(question[:50]) for question, _, _ in skipped)}")
+        return vector_store
+
+
+class KnowledgeBaseRegistry:
+    """
+    Реестр баз знаний с ленивой загрузкой и вытеснением давно не использованных баз (LRU).
+
+    База загружается при первом обращении. Если у базы еще нет активной версии коллекции,
+    первая синхронизация с Google Sheets запускается в фоне (одна на все процессы) и запросы
+    ее не ждут: пока база не собрана, KnowledgeBase.is_available() возвращает False.
+    Дальше база пересобирается только через refresh().
+    """
+
+    def __init__(self, kb_settings, sheets_manager, load_system_prompt, db_path="./db", max_loaded=8):
+        self.kb_settings = kb_settings
+        self.sheets_manager = sheets_manager
+        self.load_system_prompt = load_system_prompt
+        self.db_path = db_path
+        self.max_loaded = max_loaded
+        self.pointers = CollectionPointers(db_path)
+        self._loaded = OrderedDict()
+        # _lock защищает только словари реестра; загрузка базы идет под ее собственной блокировкой
+        self._lock = threading.Lock()
+        self._load_locks = {kb_id: threading.Lock() for kb_id in kb_settings}
+        # Базы, первая синхронизация которых идет в фоновом потоке этого процесса
+        self._syncing = set()
+
+    def __contains__(self, kb_id):
+        return kb_id in self.kb_settings
+
+    def get(self, kb_id):
+        """Возвращает базу знаний (загружая ее при необходимости) или None, если kb_id неизвестен."""
+        if kb_id not in self.kb_settings:
+            return None
+
+        with self._lock:
+            kb = self._loaded.get(kb_id)
+            if kb is not None:
+                self._loaded.move_to_end(kb_id)
+                return kb
+
+        # Загрузка одной базы не блокирует обращения к остальным
+        with self._load_locks[kb_id]:
+            with self._lock:
+                kb = self._loaded.get(kb_id)
+            if kb is None:
+                kb = self._load(kb_id)
+                with self._lock:
+                    self._loaded[kb_id] = kb
+                    evicted = self._evict()
+                for evicted_kb in evicted:
+                    evicted_kb.release()
+        return kb
+
+    def _load(self, kb_id):
+        settings = self.kb_settings[kb_id]
+        logger.info(f"Загрузка базы знаний '{kb_id}' (коллекция {settings['collection']})...")
+        kb = KnowledgeBase(kb_id, settings, self.load_system_prompt(settings["system_prompt_file"]), self.db_path, self.pointers)
+        if self.pointers.active(kb_id) is None:
+            self._start_initial_sync(kb)
+        return kb
+
+    def _start_initial_sync(self, kb):
+        with self._lock:
+            if kb.kb_id in self._syncing:
+                return
+            self._syncing.add(kb.kb_id)
+        threading.Thread(target=self._initial_sync, args=(kb,), name=f"kb-sync-{kb.kb_id}", daemon=True).start()
+
+    def _initial_sync(self, kb):
+        # Первую синхронизацию выполняет один процесс; остальные ждут, пока появится активная версия
+        # (или пока истечет аренда упавшего сборщика)
+        try:
+            while self.pointers.active(kb.kb_id) is None:
+                if not kb.rebuild(self.sheets_manager):
+                    logger.info(f"[{kb.kb_id}] База собирается другим процессом, ожидание...")
+                    time.sleep(BUILD_WAIT_INTERVAL)
+                elif self.pointers.active(kb.kb_id) is None:
+                    logger.error(f"[{kb.kb_id}] Первая синхронизация не удалась, повтор через {INITIAL_SYNC_RETRY_INTERVAL:.0f} с.")
+                    time.sleep(INITIAL_SYNC_RETRY_INTERVAL)
+        except Exception as e:
+            logger.error(f"[{kb.kb_id}] Ошибка первой синхронизации: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._syncing.discard(kb.kb_id)
+
+    def _evict(self):
+        # Вызывается под self._lock; возвращает вытесненные базы, память освобождается уже без блокировки
+        evicted = []
+        while len(self._loaded) > self.max_loaded:
+            evicted_id, evicted_kb = self._loaded.popitem(last=False)
+            evicted.append(evicted_kb)
+            logger.info(f"База знаний '{evicted_id}' выгружена из памяти (LRU, лимит {self.max_loaded}).")
+        return evicted
+
+    def refresh(self, kb_id):
+        """Пересобирает базу знаний из Google Sheets. Возвращает False, если kb_id неизвестен."""
+        if kb_id not in self.kb_settings:
+            return False
+        # Если у базы еще нет ни одной версии, get() запустит первую синхронизацию сам
+        has_version = self.pointers.active(kb_id) is not None
+        kb = self.get(kb_id)
+        if has_version and not kb.rebuild(self.sheets_manager):
+            logger.info(f"[{kb_id}] Обновление пропущено: база уже пересобирается.")
+        return True
+
+    def loaded_ids(self):
+        with self._lock:
+            return list(self._loaded)